@@ -0,0 +1,168 @@
+"""
+SNAPSHOT ANALYTIQUE DES USERS
+Copie en colonnes NumPy de la table users (solde, niveau, temps de jeu,
+dernière session, création), reconstruite périodiquement depuis le miroir
+mémoire: les commandes admin calculent dessus en opérations vectorisées.
+Sans miroir chargé il n'y a pas de snapshot (aucun scan Firestore périodique).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from repository import parse_session_time
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", "300"))
+ANALYTICS_SOURCE_RETRY = 10.0  # secondes entre deux essais tant que le miroir charge
+
+# Critères de /finduser servis par le snapshot: nom -> colonne
+SNAPSHOT_COLUMNS = {
+    'token_balance': 'token_balance',
+    'level_notified': 'level',
+    'time_on_app': 'time_on_app',
+}
+
+
+def _number(value, default=0.0):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return default
+    return float(value)
+
+
+def _epoch(value):
+    """Date (Timestamp Firestore ou last_session_time) -> secondes Unix, NaN si absente ou invalide"""
+    try:
+        parsed = parse_session_time(value)
+        return parsed.timestamp() if parsed else np.nan
+    except (ValueError, OverflowError, OSError):
+        return np.nan
+
+
+@dataclass
+class UserSnapshot:
+    usernames: np.ndarray      # object
+    token_balance: np.ndarray  # float64
+    level: np.ndarray          # float64 (level_notified, 1 par défaut)
+    time_on_app: np.ndarray    # float64, secondes
+    last_session: np.ndarray   # float64, secondes Unix (NaN = inconnue)
+    created_at: np.ndarray     # float64, secondes Unix (NaN = inconnue)
+    built_at: float
+
+    def __len__(self):
+        return len(self.usernames)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """[(username, data), ...] -> colonnes"""
+        usernames, balances, levels, times, sessions, created = [], [], [], [], [], []
+        for username, data in rows:
+            usernames.append(username)
+            balances.append(_number(data.get('token_balance', 0)))
+            levels.append(_number(data.get('level_notified', 1), 1.0))
+            times.append(_number(data.get('time_on_app', 0)))
+            sessions.append(_epoch(data.get('last_session_time')))
+            created.append(_epoch(data.get('created_at')))
+        return cls(
+            usernames=np.array(usernames, dtype=object),
+            token_balance=np.array(balances, dtype=np.float64),
+            level=np.array(levels, dtype=np.float64),
+            time_on_app=np.array(times, dtype=np.float64),
+            last_session=np.array(sessions, dtype=np.float64),
+            created_at=np.array(created, dtype=np.float64),
+            built_at=time.time(),
+        )
+
+    def summary(self, now):
+        """Totaux de /stats"""
+        count = len(self)
+        total_balance = float(self.token_balance.sum())
+        top = int(self.token_balance.argmax()) if count else None
+        # Comparaisons avec NaN = False: les sessions inconnues ne comptent nulle part
+        with np.errstate(invalid='ignore'):
+            age = now - self.last_session
+            active_24h = int((age < 86400).sum())
+            inactive_7d = int((age >= 7 * 86400).sum())
+        return {
+            "count": count,
+            "total_balance": total_balance,
+            "avg_balance": total_balance / count if count else 0,
+            "active_24h": active_24h,
+            "inactive_7d": inactive_7d,
+            "top_holder": (self.usernames[top], float(self.token_balance[top])) if top is not None else None,
+        }
+
+    def top_by(self, column, n):
+        """Les n plus grandes valeurs (> 0) de `column`: [(username, valeur), ...]"""
+        values = getattr(self, column)
+        positive = np.flatnonzero(values > 0)
+        if len(positive) > n:
+            positive = positive[np.argpartition(values[positive], -n)[-n:]]
+        order = positive[np.argsort(values[positive])[::-1]]
+        return [(self.usernames[i], float(values[i])) for i in order]
+
+    def weekly_joins(self, now, weeks=4):
+        """Nouveaux users par semaine (la plus ancienne d'abord), d'après created_at
+        ou, à défaut, la dernière session"""
+        joined = np.where(np.isnan(self.created_at), self.last_session, self.created_at)
+        edges = now - np.arange(weeks, -1, -1) * 7 * 86400
+        counts, _ = np.histogram(joined[~np.isnan(joined)], bins=edges)
+        return [int(count) for count in counts]
+
+    def find(self, field, operator, value):
+        """Users dont `field` vérifie la comparaison: [(username, valeur), ...]"""
+        values = getattr(self, SNAPSHOT_COLUMNS[field])
+        if operator == ">":
+            mask = values > value
+        elif operator == "<":
+            mask = values < value
+        else:
+            mask = values == value
+        indexes = np.flatnonzero(mask)
+        return [(self.usernames[i], values[i]) for i in indexes]
+
+
+class AnalyticsSnapshot:
+    """Détient le snapshot courant et le reconstruit périodiquement"""
+
+    def __init__(self, load_rows, interval=ANALYTICS_REFRESH_INTERVAL):
+        # load_rows(): coroutine retournant [(username, data), ...], ou None si la source n'est pas prête
+        self.load_rows = load_rows
+        self.interval = interval
+        self.snapshot = None
+        self._task = None
+
+    @property
+    def ready(self):
+        return self.snapshot is not None
+
+    async def refresh(self):
+        started = time.monotonic()
+        rows = await self.load_rows()
+        if rows is None:
+            return self.snapshot
+        self.snapshot = await asyncio.to_thread(UserSnapshot.from_rows, rows)
+        logger.info(f"Analytics snapshot rebuilt: {len(self.snapshot)} users in {time.monotonic() - started:.1f}s")
+        return self.snapshot
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Analytics snapshot refresh failed: {e}")
+            await asyncio.sleep(self.interval if self.ready else ANALYTICS_SOURCE_RETRY)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -7,8 +7,14 @@ from firebase_admin import credentials, firestore
 import json
 from dotenv import load_dotenv
 import logging
-from bot import send_referral_notification
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import hmac
+import asyncio
+from functools import wraps
+from bot import send_referral_notification, build_application, telegram_bot, BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET
+from repository import UserRepository
+from outbox import Outbox, Notification, Undeliverable
+from membership import MembershipService, MembershipError, MembershipCache, membership_cache, CHANNEL_USERNAME, MEMBERSHIP_BATCH_MAX, MEMBERSHIP_CACHE_POLLING_TTL
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 
 
 # Load environment variables from .env file
@@ -23,12 +29,12 @@ logger = logging.getLogger(__name__)
 
 # Environment Variables
 API_TOKEN = os.getenv("API_TOKEN")  # Telegram Bot API token
-CHANNEL_USERNAME = "@pxlonton"  # Your Telegram channel username
 API_KEY = os.getenv("API_KEY")  # Secure API key for the Flask API
 
 
 # Initialize Telegram Bot
-bot = telegram.Bot(token=API_TOKEN)
+# Shared process-wide client (one pooled, keep-alive HTTP connection pool)
+bot = telegram_bot
 
 # Initialize Firebase
 firebase_config = {
@@ -56,12 +62,23 @@ try:
         cred = credentials.Certificate(json.loads(json.dumps(firebase_config)))
         app_firebase = firebase_admin.initialize_app(cred, name='api_app')
     
-    db = firestore.client(app=app_firebase)
+    repo = UserRepository.from_app(app_firebase)
     logger.info("Firebase initialized successfully for API.")
 except Exception as e:
     logger.error(f"Failed to initialize Firebase: {e}")
     exit(1)
 
+# chat_member updates only reach this process in webhook mode; in polling mode they go
+# to the worker dyno, so cached "member" answers must expire quickly here
+if BOT_MODE == "webhook":
+    membership = MembershipService(repo, bot, CHANNEL_USERNAME, cache=membership_cache)
+else:
+    membership = MembershipService(repo, bot, CHANNEL_USERNAME, cache=MembershipCache(ttl=MEMBERSHIP_CACHE_POLLING_TTL))
+
+# Durable queue for referral / level bonus notifications, drained in the background
+outbox = Outbox()
+outbox_task = None
+
 app = Quart(__name__)
 
 ALLOWED_ORIGIN = "https://tokearn-a67df5f503a2.herokuapp.com"
@@ -73,6 +90,65 @@ app = cors(app, allow_origin=[
 ], allow_methods=['GET', 'POST', 'OPTIONS'], 
 allow_headers=['Content-Type', 'Authorization', 'x-api-key'])
 
+# Telegram Application running inside this process when BOT_MODE=webhook
+telegram_app = build_application() if BOT_MODE == "webhook" else None
+
+
+@app.before_serving
+async def start_telegram_application():
+    """Start the bot Application and register the webhook (webhook mode only)"""
+    if telegram_app is None:
+        # Polling mode: the web process only sends, through the shared client
+        await telegram_bot.initialize()
+        return
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET")
+
+    await telegram_app.initialize()
+    await telegram_app.post_init(telegram_app)
+    await telegram_app.start()
+
+    webhook_url = f"{WEBHOOK_URL}/telegram/webhook/{WEBHOOK_SECRET}"
+    await telegram_app.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+    logger.info("Telegram webhook registered, bot running inside the web process")
+
+
+@app.before_serving
+async def start_outbox_worker():
+    global outbox_task
+    outbox_task = asyncio.create_task(outbox.run(bot, NOTIFICATION_RENDERERS, render_notification_digest))
+
+
+@app.after_serving
+async def stop_outbox_worker():
+    if outbox_task is not None:
+        outbox_task.cancel()
+
+
+@app.after_serving
+async def stop_telegram_application():
+    if telegram_app is None:
+        await telegram_bot.shutdown()
+        return
+
+    await telegram_app.stop()
+    await telegram_app.shutdown()
+
+
+@app.route('/telegram/webhook/<secret>', methods=['POST'])
+async def telegram_webhook(secret):
+    """Receive Telegram updates and feed them to the Application"""
+    if telegram_app is None or not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return '', 404
+
+    data = await request.get_json()
+    if not data:
+        return jsonify({'error': 'Missing update'}), 400
+
+    await telegram_app.update_queue.put(Update.de_json(data, telegram_app.bot))
+    return '', 200
+
+
 @app.route('/api/notify-referral', methods=['OPTIONS'])
 async def notify_referral_options():
     """Handle preflight requests"""
@@ -80,6 +156,7 @@ async def notify_referral_options():
 
 # Simple API key authentication
 def require_api_key(f):
+    @wraps(f)
     async def decorated(*args, **kwargs):
         if 'x-api-key' not in request.headers:
             logger.warning("API key missing in request headers.")
@@ -105,17 +182,8 @@ async def proxy_verify_membership():
     logger.info(f"Proxy received request for username: {username}")
 
     try:
-        # Call the internal verification endpoint with the API_KEY
-        url = "https://guarded-forest-98367-6965ee2800e6.herokuapp.com/api/telegram/verify"
-        headers = {"Content-Type": "application/json", "x-api-key": API_KEY}
-        payload = {"username": username}
-
-        # Use an asynchronous HTTP client to make the call
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                result = await response.json()
-                return jsonify(result), response.status
+        # Same verification as /api/telegram/verify, called in-process
+        return await membership_response(username)
     except Exception as e:
         logger.error(f"Error in proxy verification: {e}")
         return jsonify({'error': str(e)}), 500
@@ -135,28 +203,17 @@ async def verify_telegram_membership():
     username = data['username']
     logger.info(f"Received verification request for username: {username}")
 
-    # Fetch user's Telegram user_id from Firestore using username
-    user_doc_ref = db.collection('users').document(username)
-    user_doc = user_doc_ref.get()
-
-    if not user_doc.exists:
-        logger.error(f"User '{username}' not found in Firestore.")
-        return jsonify({'error': 'User not found'}), 404
+    return await membership_response(username)
 
-    user_data = user_doc.to_dict()
-    user_id = user_data.get('user_id')
-
-    if not user_id:
-        logger.error(f"'user_id' not found for user '{username}'.")
-        return jsonify({'error': 'User ID not found'}), 400
 
+async def membership_response(username):
+    """Run the membership check and map the outcome to a JSON response"""
     try:
-        # Use await for asynchronous call
-        member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=int(user_id))
-        status = member.status
-        is_member = status in ['member', 'administrator', 'creator']
-        logger.info(f"User '{username}' membership status: {status}")
+        is_member = await membership.is_member(username)
         return jsonify({'isMember': is_member})
+    except MembershipError as e:
+        logger.error(f"Membership check failed for '{username}': {e}")
+        return jsonify({'error': str(e)}), e.status
     except telegram.error.BadRequest as e:
         logger.error(f"BadRequest Error: {e}")
         return jsonify({'error': f'Bad Request: {str(e)}'}), 400
@@ -165,6 +222,42 @@ async def verify_telegram_membership():
         return jsonify({'error': f'Telegram API Error: {str(e)}'}), 500
 
 
+@app.route('/api/telegram/verify-batch', methods=['POST'])
+@require_api_key
+async def verify_telegram_membership_batch():
+    """
+    Verify channel membership for many users at once.
+    Body: {"usernames": [...], "userIds": [...]}. Results are streamed back as
+    NDJSON, one object per user, in completion order.
+    """
+    data = await request.get_json()
+    if not data:
+        return jsonify({'error': 'Missing request data'}), 400
+
+    usernames = data.get('usernames') or []
+    user_ids = data.get('userIds') or []
+    if not isinstance(usernames, list) or not isinstance(user_ids, list):
+        return jsonify({'error': 'usernames and userIds must be lists'}), 400
+    if not usernames and not user_ids:
+        return jsonify({'error': 'Missing usernames or userIds'}), 400
+    if len(usernames) + len(user_ids) > MEMBERSHIP_BATCH_MAX:
+        return jsonify({'error': f'At most {MEMBERSHIP_BATCH_MAX} users per batch'}), 400
+
+    try:
+        usernames = [str(username) for username in usernames]
+        user_ids = [int(user_id) for user_id in user_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'userIds must be integers'}), 400
+
+    logger.info(f"Batch verification for {len(usernames)} usernames and {len(user_ids)} user IDs")
+
+    async def stream_results():
+        async for result in membership.check_many(usernames, user_ids):
+            yield json.dumps(result) + "\n"
+
+    return stream_results(), 200, {'Content-Type': 'application/x-ndjson'}
+
+
 @app.route('/api/public/create-stars-invoice', methods=['POST'])
 async def create_stars_invoice_public():
     """
@@ -185,11 +278,9 @@ async def create_stars_invoice_public():
             return jsonify({'error': 'Invalid amount or userId'}), 400
 
         # Vérifier que le user_id existe dans votre base
-        users_ref = db.collection('users')
-        query = users_ref.where('user_id', '==', int(user_id)).limit(1)
-        docs = list(query.stream())
+        user = await repo.find_user_by_id(int(user_id))
         
-        if not docs:
+        if user is None:
             return jsonify({'error': 'User not found'}), 404
 
         logger.info(f"Creating Stars invoice: {amount} stars for user {user_id}")
@@ -217,7 +308,7 @@ async def create_stars_invoice_public():
 
 @app.route('/api/notify-referral', methods=['POST', 'OPTIONS'])
 async def notify_referral():
-    """Endpoint to send referral notification"""
+    """Endpoint to queue a referral notification"""
     
     # Handle preflight CORS
     if request.method == 'OPTIONS':
@@ -233,53 +324,52 @@ async def notify_referral():
         referrer = data['referrer']
         new_user = data['new_user']
         
-        logger.info(f"Processing referral notification: {new_user} -> {referrer}")
-        
-        # Get referrer's chat_id from Firebase
-        try:
-            referrer_doc = db.collection('users').document(referrer).get()
-            
-            if not referrer_doc.exists:
-                logger.warning(f"Referrer {referrer} not found in Firebase")
-                return jsonify({'error': 'Referrer not found'}), 404
+        message_id = outbox.enqueue('referral', referrer, {'referrer': referrer, 'new_user': new_user})
+        logger.info(f"Queued referral notification #{message_id}: {new_user} -> {referrer}")
+        return jsonify({'success': True, 'queued': message_id}), 202
             
-            referrer_data = referrer_doc.to_dict()
-            chat_id = referrer_data.get('chat_id')
-            friends_count = referrer_data.get('friends_invited', 0)
-            
-            if not chat_id:
-                logger.warning(f"No chat_id for referrer {referrer}")
-                return jsonify({'error': 'No chat_id'}), 404
-            
-            logger.info(f"Found chat_id {chat_id} for referrer {referrer}, friends: {friends_count}")
-            
-        except Exception as e:
-            logger.error(f"Firebase error: {e}")
-            return jsonify({'error': 'Database error'}), 500
-        
-        # Calculate reward based on milestone
-        reward = 1000  # Base reward
-        milestone_bonus = 0
-        milestone_name = ""
-
-        if friends_count == 5:
-            milestone_bonus = 5000
-            milestone_name = "🏅 Recruteur Badge unlocked!"
-        elif friends_count == 10:
-            milestone_bonus = 4500
-            milestone_name = "🎖️ Ambassadeur Badge unlocked!"
-        elif friends_count == 25:
-            milestone_bonus = 39500
-            milestone_name = "👑 Legend Badge unlocked!"
-        elif friends_count == 50:
-            milestone_bonus = 100000
-            milestone_name = "💎 Elite Badge unlocked!"
-
-        total_reward = reward + milestone_bonus
-
-        # Create notification message
-        if milestone_bonus > 0:
-            message = f"""
+    except Exception as e:
+        logger.error(f"Unexpected error in notify-referral: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+REFERRAL_REWARD = 1000
+
+# friends_invited count -> (bonus, badge message)
+REFERRAL_MILESTONES = {
+    5: (5000, "🏅 Recruteur Badge unlocked!"),
+    10: (4500, "🎖️ Ambassadeur Badge unlocked!"),
+    25: (39500, "👑 Legend Badge unlocked!"),
+    50: (100000, "💎 Elite Badge unlocked!"),
+}
+
+
+async def render_referral_notification(message):
+    """Build the referral notification for the outbox worker"""
+    referrer = message.payload['referrer']
+    new_user = message.payload['new_user']
+
+    # Fresh read: the app has just incremented friends_invited
+    referrer_data = await repo.get_user(referrer, cached=False)
+    
+    if referrer_data is None:
+        raise Undeliverable(f"Referrer {referrer} not found in Firebase")
+    
+    chat_id = referrer_data.get('chat_id')
+    friends_count = referrer_data.get('friends_invited', 0)
+    
+    if not chat_id:
+        raise Undeliverable(f"No chat_id for referrer {referrer}")
+    
+    # Calculate reward based on milestone
+    reward = REFERRAL_REWARD  # Base reward
+    milestone_bonus, milestone_name = REFERRAL_MILESTONES.get(friends_count, (0, ""))
+
+    total_reward = reward + milestone_bonus
+
+    # Create notification message
+    if milestone_bonus > 0:
+        text = f"""
 🎉 *Congratulations!*
 
 *{new_user}* just joined our community using your referral link!
@@ -294,8 +384,8 @@ Total friends invited: *{friends_count}*
 
 Keep sharing to unlock bigger rewards! 🚀
 """
-        else:
-            message = f"""
+    else:
+        text = f"""
 🎉 *Congratulations!*
 
 *{new_user}* just joined our community using your referral link!
@@ -306,43 +396,19 @@ Total friends invited: *{friends_count}*
 
 Keep sharing to unlock bigger rewards! 🚀
 """
-        
-        try:
-            # Create keyboard
-            from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-            
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")],
-                [InlineKeyboardButton("📢 Share Again", 
-                    url=f"https://t.me/share/url?url=https://t.me/nestortonbot?start=ref_{referrer_data.get('referral_code', '')}")]
-            ])
-            
-            # Send notification
-            logger.info(f"Attempting to send Telegram message to chat_id {chat_id}")
-            
-            await bot.send_message(
-                chat_id=int(chat_id),
-                text=message,
-                parse_mode='Markdown',
-                reply_markup=keyboard
-            )
-            
-            logger.info(f"✅ Telegram notification sent successfully to {referrer}")
-            return jsonify({'success': True}), 200
-            
-        except Exception as e:
-            logger.error(f"Telegram API error: {e}")
-            return jsonify({'error': f'Telegram error: {str(e)}'}), 500
-            
-    except Exception as e:
-        logger.error(f"Unexpected error in notify-referral: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
-        
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")],
+        [InlineKeyboardButton("📢 Share Again", 
+            url=f"https://t.me/share/url?url=https://t.me/nestortonbot?start=ref_{referrer_data.get('referral_code', '')}")]
+    ])
+    
+    return Notification(int(chat_id), {'text': text, 'parse_mode': 'Markdown', 'reply_markup': keyboard})
 
 
 @app.route('/api/notify-level-bonus', methods=['POST', 'OPTIONS'])
 async def notify_level_bonus():
-    """Notify referrer when their friend levels up"""
+    """Queue a notification for the referrer when their friend levels up"""
     
     if request.method == 'OPTIONS':
         return '', 204
@@ -354,24 +420,40 @@ async def notify_level_bonus():
             return jsonify({'error': 'Missing parameters'}), 400
         
         referrer = data['referrer']
-        friend = data['friend']
-        level = data.get('level', 0)
-        bonus = data.get('bonus', 0)
-        
-        logger.info(f"Level bonus notification: {friend} reached level {level}")
+        payload = {
+            'referrer': referrer,
+            'friend': data['friend'],
+            'level': data.get('level', 0),
+            'bonus': data.get('bonus', 0),
+        }
         
-        referrer_doc = db.collection('users').document(referrer).get()
+        message_id = outbox.enqueue('level_bonus', referrer, payload)
+        logger.info(f"Queued level bonus notification #{message_id}: {payload['friend']} reached level {payload['level']}")
+        return jsonify({'success': True, 'queued': message_id}), 202
         
-        if not referrer_doc.exists:
-            return jsonify({'error': 'Referrer not found'}), 404
-        
-        referrer_data = referrer_doc.to_dict()
-        chat_id = referrer_data.get('chat_id')
-        
-        if not chat_id:
-            return jsonify({'error': 'No chat_id'}), 404
-        
-        message = f"""
+    except Exception as e:
+        logger.error(f"Error in notify-level-bonus: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+async def render_level_bonus_notification(message):
+    """Build the level bonus notification for the outbox worker"""
+    referrer = message.payload['referrer']
+    friend = message.payload['friend']
+    level = message.payload['level']
+    bonus = message.payload['bonus']
+
+    referrer_data = await repo.get_user(referrer)
+    
+    if referrer_data is None:
+        raise Undeliverable(f"Referrer {referrer} not found in Firebase")
+    
+    chat_id = referrer_data.get('chat_id')
+    
+    if not chat_id:
+        raise Undeliverable(f"No chat_id for referrer {referrer}")
+    
+    text = f"""
 🎉 *Level Up Bonus!*
 
 Your friend *{friend}* just reached *Level {level}*!
@@ -380,28 +462,75 @@ Your friend *{friend}* just reached *Level {level}*!
 
 Keep encouraging your friends to play! 🚀
 """
-        
-        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")],
-            [InlineKeyboardButton("👥 View Referrals", url="https://t.me/nestortonbot/hello#referral")]
-        ])
-        
-        await bot.send_message(
-            chat_id=int(chat_id),
-            text=message,
-            parse_mode='Markdown',
-            reply_markup=keyboard
-        )
-        
-        logger.info(f"Level bonus notification sent to {referrer}")
-        return jsonify({'success': True}), 200
-        
-    except Exception as e:
-        logger.error(f"Error in notify-level-bonus: {e}")
-        return jsonify({'error': str(e)}), 500
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")],
+        [InlineKeyboardButton("👥 View Referrals", url="https://t.me/nestortonbot/hello#referral")]
+    ])
+    
+    return Notification(int(chat_id), {'text': text, 'parse_mode': 'Markdown', 'reply_markup': keyboard})
+
 
+async def render_notification_digest(messages):
+    """Merge several queued notifications for the same referrer into one message"""
+    referrer = messages[0].recipient
+    new_users = [m.payload['new_user'] for m in messages if m.kind == 'referral']
+    level_ups = [m.payload for m in messages if m.kind == 'level_bonus']
+
+    referrer_data = await repo.get_user(referrer, cached=False)
+    
+    if referrer_data is None:
+        raise Undeliverable(f"Referrer {referrer} not found in Firebase")
+    
+    chat_id = referrer_data.get('chat_id')
+    friends_count = referrer_data.get('friends_invited', 0)
+    
+    if not chat_id:
+        raise Undeliverable(f"No chat_id for referrer {referrer}")
+
+    def names(items):
+        shown = ", ".join(f"*{name}*" for name in items[:3])
+        return shown if len(items) <= 3 else f"{shown} and {len(items) - 3} more"
+
+    total_reward = 0
+    lines = []
+    if new_users:
+        referral_reward = REFERRAL_REWARD * len(new_users)
+        total_reward += referral_reward
+        lines.append(f"👥 {len(new_users)} friends joined: {names(new_users)} (+{referral_reward:,} NES)")
+        # Milestones reached by this burst of referrals
+        for count in range(friends_count - len(new_users) + 1, friends_count + 1):
+            if count in REFERRAL_MILESTONES:
+                milestone_bonus, milestone_name = REFERRAL_MILESTONES[count]
+                total_reward += milestone_bonus
+                lines.append(f"{milestone_name} (+{milestone_bonus:,} NES)")
+    if level_ups:
+        level_bonus = sum(payload.get('bonus', 0) for payload in level_ups)
+        total_reward += level_bonus
+        friends = list(dict.fromkeys(payload['friend'] for payload in level_ups))
+        lines.append(f"📈 {len(level_ups)} level-ups from {names(friends)} (+{level_bonus:,} NES)")
+
+    text = "\n🎉 *Your referrals are on fire!*\n\n" + "\n".join(lines) + f"""
+
+💰 You earned *{total_reward:,} NES* tokens!
+
+Total friends invited: *{friends_count}*
+
+Keep sharing to unlock bigger rewards! 🚀
+"""
+
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")],
+        [InlineKeyboardButton("👥 View Referrals", url="https://t.me/nestortonbot/hello#referral")]
+    ])
+
+    return Notification(int(chat_id), {'text': text, 'parse_mode': 'Markdown', 'reply_markup': keyboard})
+
+
+NOTIFICATION_RENDERERS = {
+    'referral': render_referral_notification,
+    'level_bonus': render_level_bonus_notification,
+}
 
 
 if __name__ == '__main__':
@@ -4,21 +4,29 @@ Bot pour gérer les interactions Telegram avec l'application Tokearn
 Fonctionnalités: Profile, Leaderboard, Referral system, Broadcast, 15+ Admin tools
 """
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, Update, BotCommand, BotCommandScopeChat
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, BotCommand, BotCommandScopeChat
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, ExtBot
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
 import os
 import html
 import json
-from telegram.ext import PreCheckoutQueryHandler, MessageHandler, filters
+from telegram.ext import PreCheckoutQueryHandler, MessageHandler, ChatMemberHandler, filters
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-import csv
-import io
+import time
+from jobs import get_job_store, run_job
+from repository import UserRepository, USERS_COLLECTION, LEADERBOARD_COLLECTION, UPDATED_AT_FIELD, leaderboard_entries
+from mirror import CollectionMirror, USER_MIRROR_ENABLED, USER_MIRROR_LOAD_TIMEOUT
+from leaderboard_index import LeaderboardIndex
+from media import MediaRegistry
+from analytics import AnalyticsSnapshot, SNAPSHOT_COLUMNS
+from exports import EXPORT_FORMATS, ExportWatermarks, export_users, parquet_available, parse_watermark
+from grants import Grant, BulkGrantProgress, apply_grants, bulk_apply_grants, failures_csv, notify_grants, parse_grants_csv
+from membership import membership_cache, is_member_status, CHANNEL_USERNAME
 
 # ========================================
 # CONFIGURATION ET INITIALISATION
@@ -29,6 +37,23 @@ load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 
+# "polling" (dyno worker) ou "webhook" (updates reçues par api.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL publique de l'app web, ex: https://xxx.herokuapp.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Client Telegram unique du process: un seul pool de connexions HTTP keep-alive
+# partagé par les handlers, les broadcasts et api.py
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "32"))
+BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "10"))
+
+telegram_bot = ExtBot(
+    token=API_TOKEN,
+    request=HTTPXRequest(connection_pool_size=BOT_POOL_SIZE, pool_timeout=BOT_POOL_TIMEOUT),
+    # getUpdates garde sa propre connexion: le long polling ne bloque pas les envois
+    get_updates_request=HTTPXRequest(connection_pool_size=1),
+)
+
 firebase_config = {
     "type": os.getenv("FIREBASE_TYPE"),
     "project_id": os.getenv("FIREBASE_PROJECT_ID"),
@@ -45,7 +70,23 @@ firebase_config = {
 
 cred = credentials.Certificate(json.loads(json.dumps(firebase_config)))
 firebase_admin.initialize_app(cred)
-db = firestore.client()
+repo = UserRepository.from_app()
+# Miroir mémoire des users pour les commandes admin et l'index du leaderboard (USER_MIRROR_ENABLED, actif par défaut)
+user_mirror = CollectionMirror(firestore.client().collection(USERS_COLLECTION)) if USER_MIRROR_ENABLED else None
+
+# Classement incrémental, alimenté par le miroir
+leaderboard_index = LeaderboardIndex()
+if user_mirror:
+    user_mirror.add_listener(leaderboard_index.update)
+
+LEADERBOARD_SIZE = 10
+
+# Miroir du classement matérialisé (quelques documents), évite une lecture par affichage.
+# Même interrupteur que le miroir users: aucun listener permanent si USER_MIRROR_ENABLED=false
+leaderboard_mirror = CollectionMirror(firestore.client().collection(LEADERBOARD_COLLECTION)) if USER_MIRROR_ENABLED else None
+
+# Corps du leaderboard pré-rendu, recalculé seulement quand le classement change
+LEADERBOARD_CAPTION_CACHE = {"key": None, "body": "", "rows": {}}
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -53,7 +94,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor()
+# file_id Telegram des GIFs récurrents
+media_registry = MediaRegistry()
+
+# Watermarks des exports incrémentaux (/export since=last)
+export_watermarks = ExportWatermarks()
+
+
+async def load_analytics_rows():
+    """Lignes du snapshot analytique: uniquement le miroir chargé, jamais de scan Firestore"""
+    if not (user_mirror and user_mirror.ready):
+        return None
+    return user_mirror.items()
+
+
+# Snapshot NumPy des users pour /stats, /topactive, /growth et /finduser
+analytics = AnalyticsSnapshot(load_analytics_rows)
 
 # Variable globale pour le mode maintenance
 MAINTENANCE_MODE = {"enabled": False, "reason": ""}
@@ -97,6 +153,89 @@ def get_standardized_username(user):
         return "Unknown_User"
 
 
+async def iter_admin_users(fields=None):
+    """
+    Source des commandes admin: miroir mémoire s'il est chargé, sinon scan Firestore
+    limité aux `fields` demandés
+    """
+    if user_mirror and user_mirror.ready:
+        for username, user_data in user_mirror.items():
+            yield username, user_data
+    else:
+        async for username, user_data in repo.iter_users(fields=fields):
+            yield username, user_data
+
+
+# Champs lus par chaque commande admin lors d'un scan Firestore (projection)
+LISTUSERS_FIELDS = ['chat_id', 'user_id', 'token_balance']
+TOPACTIVE_FIELDS = ['time_on_app']
+GROWTH_FIELDS = ['last_session_time']
+FINDUSER_LIMIT = 20
+EXPORT_FIELDS = ['user_id', 'chat_id', 'token_balance', 'level_notified', 'friends_invited', 'claimedDay', 'time_on_app']
+
+
+async def get_top_holder():
+    """(username, token_balance) du plus gros solde: index du classement, sinon une requête"""
+    if leaderboard_index_ready():
+        top = leaderboard_index.top(1)
+        return (top[0]["username"], top[0]["token_balance"]) if top else None
+    holder = await repo.get_top_holder()
+    return (holder[0], holder[1].get('token_balance', 0)) if holder else None
+
+
+def leaderboard_index_ready():
+    """L'index n'est complet qu'une fois le miroir chargé"""
+    return bool(user_mirror and user_mirror.ready)
+
+
+async def get_top_players():
+    """Top joueurs: index mémoire si disponible, sinon classement matérialisé"""
+    if leaderboard_index_ready():
+        return leaderboard_index.top(LEADERBOARD_SIZE)
+    if leaderboard_mirror and leaderboard_mirror.ready:
+        return leaderboard_entries(leaderboard_mirror.items())
+    return await repo.get_leaderboard()
+
+
+def render_leaderboard_body(entries):
+    """
+    Rend le corps partagé du leaderboard, une seule fois par version du classement.
+    Retourne (body, rows) où rows[username] = (début, fin, rang, ligne mise en avant).
+    """
+    key = tuple(
+        (entry["rank"], entry.get("username"), entry.get("token_balance", 0), entry.get("level", 1))
+        for entry in entries
+    )
+    cache = LEADERBOARD_CAPTION_CACHE
+    
+    if cache["key"] != key:
+        body = ""
+        rows = {}
+        for rank, user, balance, level in key:
+            formatted_balance = format_number(balance)
+            escaped_user = html.escape(user)
+            
+            if rank == 1:
+                line = f"🥇 <b>{rank} - {escaped_user}</b> | 💰 {formatted_balance} NES | 🏅 Lvl {level}\n"
+            else:
+                line = f"{rank} - {escaped_user} | 💰 {formatted_balance} NES | Lvl {level}\n"
+            highlighted = f"🌟 <b>{rank} - {escaped_user}</b> | 💰 {formatted_balance} NES | Lvl {level}\n"
+            
+            rows[user] = (len(body), len(body) + len(line), rank, highlighted)
+            body += line
+        
+        cache.update(key=key, body=body, rows=rows)
+    
+    return cache["body"], cache["rows"]
+
+
+async def get_admin_user(username):
+    """Lecture d'un user pour les commandes admin (miroir si chargé)"""
+    if user_mirror and user_mirror.ready:
+        return user_mirror.get(username)
+    return await repo.get_user(username)
+
+
 # ========================================
 # HANDLER: /start
 # ========================================
@@ -130,24 +269,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         logger.info(f"User '{username}' with ID '{user_id}' started the bot.")
 
-        user_doc_ref = db.collection('users').document(username)
-        loop = asyncio.get_event_loop()
-        user_doc = await loop.run_in_executor(executor, user_doc_ref.get)
-
-        user_data = {
-            "chat_id": chat_id,
-            "user_id": user_id
-        }
-        
-        if referral_code:
-            user_data["pending_referral_code"] = referral_code
-
-        if user_doc.exists:
-            # User existant - juste update
-            await loop.run_in_executor(executor, user_doc_ref.update, user_data)
-        else:
-            user_data["created_at"] = firestore.SERVER_TIMESTAMP
-            await loop.run_in_executor(executor, user_doc_ref.set, user_data)
+        # Une seule écriture (aucune si chat_id/user_id sont déjà à jour)
+        extra = {"pending_referral_code": referral_code} if referral_code else None
+        await repo.register_user(username, chat_id, user_id, extra)
 
         if referral_code:
             webapp_url = f'https://t.me/nestortonbot/hello?startapp=ref_{referral_code}'
@@ -196,13 +320,12 @@ Ready to join the battle for NES? Start farming, trading, and earning on TON tod
 async def send_referral_notification(referrer_username, new_user_username):
     """Envoie une notification Telegram quand quelqu'un rejoint via un lien de référence"""
     try:
-        referrer_doc = db.collection('users').document(referrer_username).get()
+        referrer_data = await repo.get_user(referrer_username)
         
-        if not referrer_doc.exists:
+        if referrer_data is None:
             logger.warning(f"Referrer {referrer_username} not found")
             return
         
-        referrer_data = referrer_doc.to_dict()
         chat_id = referrer_data.get('chat_id')
         
         if not chat_id:
@@ -224,8 +347,7 @@ Keep sharing to unlock more rewards! 🚀
             [InlineKeyboardButton("📢 Share Again", url="https://t.me/share/url?url=https://t.me/nestortonbot")]
         ])
         
-        bot = Bot(token=API_TOKEN)
-        await bot.send_message(
+        await telegram_bot.send_message(
             chat_id=chat_id,
             text=message,
             parse_mode='Markdown',
@@ -243,17 +365,15 @@ async def referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = get_standardized_username(update.effective_user)
     
     try:
-        user_doc_ref = db.collection('users').document(username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(username)
         
-        if not user_doc.exists:
+        if user_data is None:
             message = "❌ *Launch the app first!*\n\nYou need to open the Tokearn app at least once to generate your referral link.\n\nClick below to launch the app:"
             keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🚀 Launch App", url="https://t.me/nestortonbot/hello")]])
             await update.callback_query.answer()
             await update.callback_query.message.reply_text(message, parse_mode='Markdown', reply_markup=keyboard)
             return
         
-        user_data = user_doc.to_dict()
         referral_code = user_data.get('referral_code')
         
         if not referral_code:
@@ -310,31 +430,23 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Affiche le classement des meilleurs joueurs"""
     username = get_standardized_username(update.effective_user)
     user_rank = None
-    leaderboard_text = ""
     header = "✨ <b>Top Players</b> ✨\n\n"
 
     try:
-        leaderboard_ref = db.collection('mainleaderboard')
-        leaderboard_docs = leaderboard_ref.stream()
-        sorted_docs = sorted(leaderboard_docs, key=lambda d: int(d.id))
-
-        for doc in sorted_docs:
-            rank = int(doc.id)
-            data = doc.to_dict()
-            user = data.get("username")
-            balance = data.get("token_balance", 0)
-            level = data.get("level", 1)
-
-            formatted_balance = format_number(balance)
-            escaped_user = html.escape(user)
-
-            if user == username:
-                user_rank = rank
-                leaderboard_text += f"🌟 <b>{rank} - {escaped_user}</b> | 💰 {formatted_balance} NES | Lvl {level}\n"
-            elif rank == 1:
-                leaderboard_text += f"🥇 <b>{rank} - {escaped_user}</b> | 💰 {formatted_balance} NES | 🏅 Lvl {level}\n"
-            else:
-                leaderboard_text += f"{rank} - {escaped_user} | 💰 {formatted_balance} NES | Lvl {level}\n"
+        # Rang exact via l'index, même hors du top affiché
+        if leaderboard_index_ready():
+            user_rank = leaderboard_index.rank(username)
+
+        body, rows = render_leaderboard_body(await get_top_players())
+
+        # Seule la ligne du user diffère: on la remplace dans le corps partagé
+        row = rows.get(username)
+        if row:
+            start, end, rank, highlighted = row
+            leaderboard_text = body[:start] + highlighted + body[end:]
+            user_rank = user_rank or rank
+        else:
+            leaderboard_text = body
 
         if user_rank:
             rank_text = f"Your rank is: <b>#{user_rank}</b> 🎉\n\n"
@@ -350,17 +462,19 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if update.callback_query:
             await update.callback_query.answer()
-            await context.bot.send_animation(
-                chat_id=update.effective_chat.id,
-                animation="https://i.imgur.com/gdyscr0.gif",
+            await media_registry.send_animation(
+                context.bot,
+                update.effective_chat.id,
+                "https://i.imgur.com/gdyscr0.gif",
                 caption=header + rank_text + leaderboard_text + footer,
                 reply_markup=keyboard,
                 parse_mode="HTML"
             )
         else:
-            await context.bot.send_animation(
-                chat_id=update.effective_chat.id,
-                animation="https://i.imgur.com/gdyscr0.gif",
+            await media_registry.send_animation(
+                context.bot,
+                update.effective_chat.id,
+                "https://i.imgur.com/gdyscr0.gif",
                 caption=header + rank_text + leaderboard_text + footer,
                 reply_markup=keyboard,
                 parse_mode="HTML"
@@ -386,12 +500,9 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = get_standardized_username(update.effective_user)
     
     try:
-        user_doc_ref = db.collection('users').document(username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(username)
 
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            
+        if user_data is not None:
             claimed_day = user_data.get('claimedDay', 'Not Available')
             last_claim_timestamp = user_data.get('lastClaimTimestamp', 'Not Available')
             last_session_time = user_data.get('last_session_time', 'Not Available')
@@ -436,17 +547,19 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if update.callback_query:
                 await update.callback_query.answer()
-                await context.bot.send_animation(
-                    chat_id=update.effective_chat.id,
-                    animation="https://i.imgur.com/NqniPEJ.gif",
+                await media_registry.send_animation(
+                    context.bot,
+                    update.effective_chat.id,
+                    "https://i.imgur.com/NqniPEJ.gif",
                     caption=profile_message,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
                 )
             else:
-                await context.bot.send_animation(
-                    chat_id=update.effective_chat.id,
-                    animation="https://i.imgur.com/NqniPEJ.gif",
+                await media_registry.send_animation(
+                    context.bot,
+                    update.effective_chat.id,
+                    "https://i.imgur.com/NqniPEJ.gif",
                     caption=profile_message,
                     reply_markup=keyboard,
                     parse_mode='Markdown'
@@ -473,12 +586,120 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ADMIN: BROADCAST
 # ========================================
 
-async def send_update_to_all_users():
-    """Envoie un message à tous les utilisateurs enregistrés"""
-    bot = Bot(token=API_TOKEN)
-    users_ref = db.collection('users')
-    docs = users_ref.stream()
+job_store = get_job_store()
+_background_tasks = set()
 
+
+def audience_chat_id(audience, user_data):
+    """Retourne le chat_id de l'utilisateur s'il fait partie de l'audience du job"""
+    chat_id = user_data.get('chat_id')
+    if not chat_id:
+        return None
+    
+    audience_type = audience.get('type', 'all')
+    if audience_type == 'level':
+        if user_data.get('level_notified', 1) < audience['min_level']:
+            return None
+    elif audience_type == 'active':
+        last_session = user_data.get('last_session_time')
+        if not isinstance(last_session, int) or last_session < audience['since_ms']:
+            return None
+    
+    return chat_id
+
+
+# Champs lus pour construire une audience
+AUDIENCE_FIELDS = ['chat_id', 'level_notified', 'last_session_time']
+
+
+def audience_query_filter(audience):
+    """Filtre Firestore (champ, opérateur, valeur) équivalent à l'audience, ou None pour tout parcourir"""
+    audience_type = audience.get('type', 'all')
+    # level_notified absent vaut 1: un filtre serveur exclurait ces users
+    if audience_type == 'level' and audience['min_level'] > 1:
+        return ('level_notified', '>=', audience['min_level'])
+    if audience_type == 'active':
+        return ('last_session_time', '>=', audience['since_ms'])
+    return None
+
+
+async def fetch_audience_page(audience, cursor, limit):
+    """
+    Lit une page de l'audience. Sans filtre: users triés par ID de document (curseur = ID).
+    Avec filtre: seuls les users concernés sont lus (curseur = JSON [valeur, ID]).
+    """
+    audience_filter = audience_query_filter(audience)
+    if audience_filter is None:
+        page = await repo.get_users_page(cursor, limit, AUDIENCE_FIELDS)
+        return [(username, audience_chat_id(audience, user_data)) for username, user_data in page]
+
+    field, op, value = audience_filter
+    try:
+        position = json.loads(cursor) if cursor else None
+    except ValueError:
+        # Curseur d'un job antérieur (ID de document): on repart du début, les envois déjà faits sont sautés
+        position = None
+    page = await repo.get_users_where(field, op, value, position, limit, AUDIENCE_FIELDS)
+    return [
+        (json.dumps([user_data.get(field), username]), audience_chat_id(audience, user_data))
+        for username, user_data in page
+    ]
+
+
+def make_job_sender(bot, payload):
+    """Reconstruit la fonction d'envoi d'un job à partir de son payload"""
+    method = getattr(bot, payload['method'])
+    kwargs = dict(payload['kwargs'])
+    if payload.get('reply_markup'):
+        kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(payload['reply_markup'], bot)
+    
+    async def send(chat_id):
+        if payload['method'] == 'send_animation':
+            # Réutilise le file_id: pas de téléchargement de l'URL par message
+            animation = kwargs['animation']
+            other_kwargs = {k: v for k, v in kwargs.items() if k != 'animation'}
+            await media_registry.send_animation(bot, chat_id, animation, **other_kwargs)
+        else:
+            await method(chat_id=chat_id, **kwargs)
+    
+    return send
+
+
+def create_broadcast_job(kind, method, kwargs, audience, notify_chat_id, done_message, reply_markup=None):
+    """Enregistre un nouveau job de broadcast"""
+    payload = {
+        "method": method,
+        "kwargs": kwargs,
+        "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        "notify_chat_id": notify_chat_id,
+        "done_message": done_message,
+    }
+    return job_store.create(kind, payload, audience)
+
+
+async def run_broadcast_job(bot, job):
+    """Exécute un job puis envoie le résumé à l'admin"""
+    try:
+        job = await run_job(job_store, job, fetch_audience_page, make_job_sender(bot, job.payload))
+    except Exception as e:
+        logger.error(f"Broadcast job #{job.id} will resume on next start: {e}")
+        return
+    
+    notify_chat_id = job.payload.get('notify_chat_id')
+    if notify_chat_id:
+        done_message = job.payload['done_message'].format(sent=job.sent, failed=job.failed)
+        await bot.send_message(chat_id=notify_chat_id, text=done_message)
+
+
+def start_broadcast_job(bot, job):
+    """Lance un job en tâche de fond"""
+    task = asyncio.create_task(run_broadcast_job(bot, job))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def send_update_to_all_users(bot, notify_chat_id=None):
+    """Envoie un message à tous les utilisateurs enregistrés"""
     update_message = """🎮 *New Game Alert!* 
 
 🚀 We're excited to announce our brand new Unity game is now available for testing!
@@ -496,29 +717,24 @@ Your feedback will help us make the game even better! 🌟"""
         [InlineKeyboardButton("👤 View Profile", callback_data='profile')]
     ])
 
-    for doc in docs:
-        user_data = doc.to_dict()
-        chat_id = user_data.get("chat_id")
-        if chat_id:
-            try:
-                await bot.send_animation(
-                    chat_id=chat_id,
-                    animation=gif_url,
-                    caption=update_message,
-                    parse_mode='Markdown',
-                    reply_markup=keyboard
-                )
-                logger.info(f"Broadcast sent to chat_id {chat_id}")
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                logger.error(f"Failed to send to chat_id {chat_id}: {e}")
+    job = create_broadcast_job(
+        kind="broadcast",
+        method="send_animation",
+        kwargs={"animation": gif_url, "caption": update_message, "parse_mode": "Markdown"},
+        audience={"type": "all"},
+        notify_chat_id=notify_chat_id,
+        done_message="Update sent to {sent} users ({failed} failed).",
+        reply_markup=keyboard
+    )
+    start_broadcast_job(bot, job)
+    return job
 
 
 async def broadcast(update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /broadcast - RÉSERVÉE À L'ADMIN"""
     if update.effective_user.username == ADMIN_USERNAME:
-        await send_update_to_all_users()
-        await update.message.reply_text("Update sent to all users.")
+        job = await send_update_to_all_users(context.bot, update.effective_chat.id)
+        await update.message.reply_text(f"📤 Broadcast job #{job.id} started. You'll get a summary when it's done.")
     else:
         await update.message.reply_text("You don't have permission to use this command.")
 
@@ -544,14 +760,12 @@ async def sendto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = ' '.join(context.args[1:])
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(target_username)
         
-        if not user_doc.exists:
+        if user_data is None:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
-        user_data = user_doc.to_dict()
         chat_id = user_data.get('chat_id')
         
         if not chat_id:
@@ -565,8 +779,7 @@ async def sendto(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("💬 Contact Support", url="https://t.me/pxlonton")]
         ])
         
-        bot = Bot(token=API_TOKEN)
-        await bot.send_message(chat_id=chat_id, text=admin_message, parse_mode='Markdown', reply_markup=keyboard)
+        await context.bot.send_message(chat_id=chat_id, text=admin_message, parse_mode='Markdown', reply_markup=keyboard)
         
         await update.message.reply_text(f"✅ Message sent to {target_username}!\n\n*Preview:*\n{message_text}", parse_mode='Markdown')
         logger.info(f"Admin message sent to {target_username}: {message_text}")
@@ -594,14 +807,13 @@ async def sendto_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = ' '.join(context.args[2:])
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(target_username)
         
-        if not user_doc.exists:
+        if user_data is None:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
-        chat_id = user_doc.to_dict().get('chat_id')
+        chat_id = user_data.get('chat_id')
         if not chat_id:
             await update.message.reply_text(f"❌ No chat_id for '{target_username}'.")
             return
@@ -613,8 +825,7 @@ async def sendto_gif(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("💬 Reply", url="https://t.me/pxlonton")]
         ])
         
-        bot = Bot(token=API_TOKEN)
-        await bot.send_animation(chat_id=chat_id, animation=gif_url, caption=admin_message, parse_mode='Markdown', reply_markup=keyboard)
+        await media_registry.send_animation(context.bot, chat_id, gif_url, caption=admin_message, parse_mode='Markdown', reply_markup=keyboard)
         
         await update.message.reply_text(f"✅ GIF message sent to {target_username}!", parse_mode='Markdown')
         logger.info(f"Admin GIF sent to {target_username}")
@@ -631,16 +842,11 @@ async def listusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        users_ref = db.collection('users')
-        docs = users_ref.stream()
-        
         user_list = []
         total_users = 0
         
-        for doc in docs:
+        async for username, user_data in iter_admin_users(LISTUSERS_FIELDS):
             total_users += 1
-            user_data = doc.to_dict()
-            username = doc.id
             chat_id = user_data.get('chat_id', 'N/A')
             user_id = user_data.get('user_id', 'N/A')
             token_balance = user_data.get('token_balance', 0)
@@ -690,14 +896,12 @@ async def userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_username = context.args[0]
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        user_data = await get_admin_user(target_username)
         
-        if not user_doc.exists:
+        if user_data is None:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
-        user_data = user_doc.to_dict()
         
         chat_id = user_data.get('chat_id', 'N/A')
         user_id = user_data.get('user_id', 'N/A')
@@ -761,73 +965,40 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await update.message.reply_text("🔄 Collecting statistics...")
         
-        users_ref = db.collection('users')
-        all_users = list(users_ref.stream())
-        
-        total_users = len(all_users)
         now = datetime.utcnow()
+        now_utc = datetime.now(timezone.utc)
+        now_ms = int(now_utc.timestamp() * 1000)
+        
+        if analytics.ready:
+            # Snapshot en colonnes: calcul vectorisé, sans lecture Firestore
+            summary = analytics.snapshot.summary(now_utc.timestamp())
+            total_users = summary["count"]
+            total_balance = int(summary["total_balance"])
+            active_24h, inactive_7d = summary["active_24h"], summary["inactive_7d"]
+            top = summary["top_holder"]
+            source = f"snapshot ({int(time.time() - analytics.snapshot.built_at)}s old)"
+        else:
+            # Agrégations côté serveur: temps constant quel que soit le nombre de users
+            totals, active_24h, inactive_7d, top = await asyncio.gather(
+                repo.user_totals(),
+                # last_session_time est en millisecondes UTC (même filtre que sendto_active)
+                repo.count_users(('last_session_time', '>=', now_ms - 86400 * 1000)),
+                repo.count_users(('last_session_time', '<', now_ms - 7 * 86400 * 1000)),
+                get_top_holder(),
+            )
+            total_users = totals["count"]
+            total_balance = totals["total_balance"]
+            source = "live aggregation"
         
-        # Users actifs
-        active_24h = 0
-        inactive_7d = 0
-        total_balance = 0
-        top_holder = {"username": "N/A", "balance": 0}
-        
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            balance = user_data.get('token_balance', 0)
-            total_balance += balance
-            
-            if balance > top_holder["balance"]:
-                top_holder = {"username": user_doc.id, "balance": balance}
-            
-            last_session = user_data.get('last_session_time')
-            
-            if last_session:
-                try:
-                    last_session_date = None
-                    
-                    # Cas 1: Timestamp en millisecondes (int)
-                    if isinstance(last_session, int):
-                        # Vérifier si c'est en millisecondes ou secondes
-                        if last_session > 10000000000:  # Plus grand = millisecondes
-                            last_session_date = datetime.utcfromtimestamp(last_session / 1000)
-                        else:  # Sinon c'est en secondes
-                            last_session_date = datetime.utcfromtimestamp(last_session)
-                    
-                    # Cas 2: String timestamp
-                    elif isinstance(last_session, str):
-                        try:
-                            timestamp_int = int(last_session)
-                            if timestamp_int > 10000000000:
-                                last_session_date = datetime.utcfromtimestamp(timestamp_int / 1000)
-                            else:
-                                last_session_date = datetime.utcfromtimestamp(timestamp_int)
-                        except ValueError:
-                            # Peut-être un format ISO ou autre
-                            logger.warning(f"Unknown date format for {user_doc.id}: {last_session}")
-                    
-                    # Cas 3: Firestore Timestamp
-                    elif hasattr(last_session, 'timestamp'):
-                        last_session_date = datetime.utcfromtimestamp(last_session.timestamp())
-                    
-                    # Calculer si actif/inactif
-                    if last_session_date:
-                        days_diff = (now - last_session_date).days
-                        
-                        if days_diff < 1:
-                            active_24h += 1
-                        if days_diff >= 7:
-                            inactive_7d += 1
-                
-                except Exception as e:
-                    logger.error(f"Error parsing date for {user_doc.id}: {e} | Value: {last_session}")
+        top_holder = {"username": top[0], "balance": int(top[1])} if top else {"username": "N/A", "balance": 0}
         
         avg_balance = total_balance / total_users if total_users > 0 else 0
         
         # ✅ Échapper le username du top holder
         escaped_top_holder = html.escape(top_holder["username"])
         
+        cache_stats = repo.cache.stats()
+        
         stats_message = f"""
 📊 <b>Bot Statistics</b>
 
@@ -840,7 +1011,12 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
   ├─ Avg balance: {format_number(int(avg_balance))} NES
   └─ Top holder: {escaped_top_holder} ({format_number(top_holder["balance"])})
 
+🗄️ <b>User cache:</b>
+  ├─ Hits: {cache_stats["hits"]} | Misses: {cache_stats["misses"]}
+  └─ Hit rate: {cache_stats["hit_rate"]:.0%} ({cache_stats["size"]} cached)
+
 📅 <b>Generated:</b> {now.strftime('%Y-%m-%d %H:%M')} UTC
+🧮 <b>Source:</b> {source}
 """
         
         # ✅ Utiliser HTML
@@ -860,22 +1036,26 @@ async def topactive(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        users_ref = db.collection('users')
-        all_users = list(users_ref.stream())
-        
-        user_activity = []
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            time_on_app = user_data.get('time_on_app', 0)
-            if time_on_app > 0:
-                hours = time_on_app / 3600
-                user_activity.append({
-                    "username": user_doc.id,
-                    "hours": hours
-                })
-        
-        user_activity.sort(key=lambda x: x["hours"], reverse=True)
-        top_5 = user_activity[:5]
+        if analytics.ready:
+            top_5 = [
+                {"username": username, "hours": seconds / 3600}
+                for username, seconds in analytics.snapshot.top_by('time_on_app', 5)
+            ]
+        else:
+            all_users = [user async for user in iter_admin_users(TOPACTIVE_FIELDS)]
+            
+            user_activity = []
+            for username, user_data in all_users:
+                time_on_app = user_data.get('time_on_app', 0)
+                if time_on_app > 0:
+                    hours = time_on_app / 3600
+                    user_activity.append({
+                        "username": username,
+                        "hours": hours
+                    })
+            
+            user_activity.sort(key=lambda x: x["hours"], reverse=True)
+            top_5 = user_activity[:5]
         
         message = "🔥 *Most Active Users (Last 7 Days)*\n\n"
         
@@ -902,10 +1082,11 @@ async def growth(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        users_ref = db.collection('users')
-        all_users = list(users_ref.stream())
-        
-        total_users = len(all_users)
+        if analytics.ready:
+            total_users = len(analytics.snapshot)
+        else:
+            all_users = [user async for user in iter_admin_users(GROWTH_FIELDS)]
+            total_users = len(all_users)
         
         # Si moins de 10 users, afficher un message simple
         if total_users < 10:
@@ -924,31 +1105,34 @@ _Keep growing! 🚀_
         now = datetime.utcnow()
         weeks_data = []
         
-        for week_offset in range(4, 0, -1):  # Semaines 4, 3, 2, 1
-            week_start = now - timedelta(weeks=week_offset)
-            week_end = now - timedelta(weeks=week_offset-1)
+        if analytics.ready:
+            # Histogramme vectorisé sur created_at (ou la dernière session à défaut)
+            weeks_data = analytics.snapshot.weekly_joins(time.time())
+        else:
+            for week_offset in range(4, 0, -1):  # Semaines 4, 3, 2, 1
+                week_start = now - timedelta(weeks=week_offset)
+                week_end = now - timedelta(weeks=week_offset-1)
             
-            count = 0
-            for user_doc in all_users:
-                user_data = user_doc.to_dict()
+                count = 0
+                for username, user_data in all_users:
                 
-                # Essayer de trouver une date de création
-                created_at = None
+                    # Essayer de trouver une date de création
+                    created_at = None
                 
-                # Option 1: Champ last_session_time comme proxy
-                if 'last_session_time' in user_data:
-                    try:
-                        last_session = user_data.get('last_session_time')
-                        if isinstance(last_session, int):
-                            created_at = datetime.utcfromtimestamp(last_session / 1000)
-                    except:
-                        pass
+                    # Option 1: Champ last_session_time comme proxy
+                    if 'last_session_time' in user_data:
+                        try:
+                            last_session = user_data.get('last_session_time')
+                            if isinstance(last_session, int):
+                                created_at = datetime.utcfromtimestamp(last_session / 1000)
+                        except:
+                            pass
                 
-                # Compter si dans cette semaine
-                if created_at and week_start <= created_at < week_end:
-                    count += 1
+                    # Compter si dans cette semaine
+                    if created_at and week_start <= created_at < week_end:
+                        count += 1
             
-            weeks_data.append(count)
+                weeks_data.append(count)
         
         # Si pas de données de dates, afficher simplement le total
         if sum(weeks_data) == 0:
@@ -1009,7 +1193,8 @@ async def givecoins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 3:
         await update.message.reply_text(
             "❌ Usage: /givecoins <username> <amount> <reason>\n"
-            'Example: /givecoins johndoe 5000 "Great job!"'
+            'Example: /givecoins johndoe 5000 "Great job!"\n\n'
+            "Bulk: upload a CSV (username,amount,reason) with the caption /givecoins"
         )
         return
     
@@ -1023,23 +1208,29 @@ async def givecoins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reason = ' '.join(context.args[2:])
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        grant = Grant(target_username, amount, gift_notification(amount, reason), reason)
+        result = await apply_grants(repo, context.bot, [grant])
         
-        if not user_doc.exists:
+        if result.missing:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
-        # Ajouter les tokens
-        user_doc_ref.update({
-            "token_balance": firestore.Increment(amount)
-        })
+        await update.message.reply_text(f"✅ Sent {format_number(amount)} NES to {target_username}!")
+        logger.info(f"Admin gave {amount} NES to {target_username}: {reason}")
         
-        # Envoyer notification au user
-        chat_id = user_doc.to_dict().get('chat_id')
-        if chat_id:
-            bot = Bot(token=API_TOKEN)
-            user_message = f"""
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        await update.message.reply_text(f"❌ Error: {str(e)}")
+
+
+BULK_PROGRESS_INTERVAL = 3  # secondes entre deux mises à jour du message de progression
+# Taille max du CSV de /givecoins (le fichier est lu en mémoire): ~50k lignes
+GIVECOINS_CSV_MAX_BYTES = int(os.getenv("GIVECOINS_CSV_MAX_BYTES", str(2 * 1024 * 1024)))
+
+
+def gift_notification(amount, reason):
+    """Message envoyé au user crédité par /givecoins"""
+    user_message = f"""
 🎁 *You received a gift!*
 
 💰 +{format_number(amount)} NES tokens
@@ -1048,17 +1239,94 @@ async def givecoins(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 From: Tokearn Team
 """
-            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")]])
-            await bot.send_message(chat_id=chat_id, text=user_message, parse_mode='Markdown', reply_markup=keyboard)
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🎮 Open App", url="https://t.me/nestortonbot/hello")]])
+    return {"text": user_message, "parse_mode": "Markdown", "reply_markup": keyboard}
+
+
+async def givecoins_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV envoyé avec la légende /givecoins - Dons en masse (username,amount,reason)"""
+    if update.effective_user.username != ADMIN_USERNAME:
+        await update.message.reply_text("❌ Permission denied.")
+        return
+    
+    try:
+        document = update.message.document
+        if document.file_size and document.file_size > GIVECOINS_CSV_MAX_BYTES:
+            await update.message.reply_text(
+                f"❌ CSV too large ({document.file_size // 1024} KB, max {GIVECOINS_CSV_MAX_BYTES // 1024} KB). "
+                f"Split it into several files."
+            )
+            return
         
-        await update.message.reply_text(f"✅ Sent {format_number(amount)} NES to {target_username}!")
-        logger.info(f"Admin gave {amount} NES to {target_username}: {reason}")
+        status_message = await update.message.reply_text("📥 Reading CSV...")
+        csv_file = await update.message.document.get_file()
+        data = bytes(await csv_file.download_as_bytearray())
+        
+        grants, failures = parse_grants_csv(data)
+        if not grants:
+            await status_message.edit_text(f"❌ No valid rows found ({len(failures)} rejected).")
+            return
+        
+        # Traitement en tâche de fond: le bot continue de répondre pendant le versement
+        context.application.create_task(
+            run_bulk_givecoins(context.bot, update.effective_chat.id, status_message, grants, failures)
+        )
         
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error(f"Error in bulk givecoins: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
 
+async def run_bulk_givecoins(bot, chat_id, status_message, grants, failures):
+    """Valide, crédite (BulkWriter) puis notifie, en mettant à jour la progression"""
+    progress = BulkGrantProgress(failures=failures)
+    task = asyncio.create_task(bulk_apply_grants(repo, firestore.client(), grants, progress))
+    
+    last_text = None
+    while not task.done():
+        await asyncio.wait({task}, timeout=BULK_PROGRESS_INTERVAL)
+        text = (
+            f"⏳ Bulk givecoins in progress...\n\n"
+            f"🔎 Validated: {progress.validated}/{progress.total}\n"
+            f"💰 Credited: {progress.written}\n"
+            f"❌ Failed: {len(progress.failures)}"
+        )
+        if text != last_text:
+            try:
+                await status_message.edit_text(text)
+                last_text = text
+            except Exception as e:
+                logger.warning(f"Could not update bulk progress: {e}")
+    
+    try:
+        credited = task.result()
+    except Exception as e:
+        logger.error(f"Bulk givecoins failed: {e}")
+        await bot.send_message(chat_id=chat_id, text=f"❌ Bulk givecoins failed: {str(e)}")
+        return
+    
+    for grant, _ in credited:
+        grant.notification = gift_notification(grant.amount, grant.reason or "Tokearn reward")
+    total = sum(grant.amount for grant, _ in credited)
+    await status_message.edit_text(
+        f"✅ Credited {format_number(total)} NES to {len(credited)} users.\n"
+        f"❌ Failed: {len(progress.failures)}\n\n"
+        f"📤 Sending notifications..."
+    )
+    logger.info(f"Admin bulk gave {total} NES to {len(credited)} users ({len(progress.failures)} failures)")
+    
+    if progress.failures:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=failures_csv(progress.failures),
+            filename=f'givecoins_failures_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
+            caption=f"❌ {len(progress.failures)} rows were not credited"
+        )
+    
+    sent = await notify_grants(bot, credited)
+    await bot.send_message(chat_id=chat_id, text=f"📨 Notifications: {sent.sent} sent, {sent.failed} failed")
+
+
 # 5️⃣ GIVEAWAY - Lancer un concours (simplifié)
 async def giveaway(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /giveaway - Lancer un concours"""
@@ -1106,50 +1374,32 @@ async def reward_top3(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        leaderboard_ref = db.collection('mainleaderboard')
-        leaderboard_docs = leaderboard_ref.stream()
-        
-        # Trier par l'ID du document (qui est le rang)
-        sorted_docs = sorted(leaderboard_docs, key=lambda d: int(d.id))
-        top_docs = sorted_docs[:3]
+        # Classement trié par rang
+        top_docs = (await get_top_players())[:3]
         
         rewards = [10000, 5000, 2500]
         
         message = "🏆 <b>Rewarding Top 3 Players...</b>\n\n"
         
-        bot = Bot(token=API_TOKEN)
-        
-        for i, doc in enumerate(top_docs):
-            data = doc.to_dict()
-            username = data.get("username")
-            reward = rewards[i]
-            
-            # Ajouter les tokens
-            user_doc_ref = db.collection('users').document(username)
-            user_doc_ref.update({
-                "token_balance": firestore.Increment(reward)
+        grants = [
+            Grant(data.get("username"), rewards[i], {
+                "text": f"🏆 Congratulations! You ranked #{i+1} and received {format_number(rewards[i])} NES! 🎉"
             })
-            
-            # Notifier le user
-            user_doc = user_doc_ref.get()
-            if user_doc.exists:
-                chat_id = user_doc.to_dict().get('chat_id')
-                if chat_id:
-                    try:
-                        user_message = f"🏆 Congratulations! You ranked #{i+1} and received {format_number(reward)} NES! 🎉"
-                        await bot.send_message(
-                            chat_id=chat_id, 
-                            text=user_message
-                        )
-                        logger.info(f"Reward notification sent to {username}")
-                    except Exception as e:
-                        logger.error(f"Failed to notify {username}: {e}")
-            
+            for i, data in enumerate(top_docs)
+        ]
+        
+        # Un seul commit pour tous les gagnants, notifications envoyées ensuite en parallèle
+        result = await apply_grants(repo, context.bot, grants)
+        
+        for i, grant in enumerate(grants):
             # ✅ Échapper le username pour éviter les erreurs HTML
-            escaped_username = html.escape(username)
-            message += f"{i+1}. {escaped_username} - Sent {format_number(reward)} NES ✅\n"
+            escaped_username = html.escape(grant.username)
+            if grant.username in result.missing:
+                message += f"{i+1}. {escaped_username} - Not found ❌\n"
+            else:
+                message += f"{i+1}. {escaped_username} - Sent {format_number(grant.amount)} NES ✅\n"
         
-        total = sum(rewards)
+        total = sum(grant.amount for grant in result.applied)
         message += f"\n<b>Total distributed:</b> {format_number(total)} NES"
         
         # ✅ Utiliser HTML au lieu de Markdown
@@ -1198,22 +1448,17 @@ _Tokearn Team_
 """
     
     try:
-        bot = Bot(token=API_TOKEN)
-        users_ref = db.collection('users')
-        docs = users_ref.stream()
-        
-        count = 0
-        for doc in docs:
-            chat_id = doc.to_dict().get("chat_id")
-            if chat_id:
-                try:
-                    await bot.send_message(chat_id=chat_id, text=announcement, parse_mode='Markdown')
-                    count += 1
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Failed: {e}")
-        
-        await update.message.reply_text(f"✅ Announcement sent to {count} users!")
+        job = create_broadcast_job(
+            kind="announce",
+            method="send_message",
+            kwargs={"text": announcement, "parse_mode": "Markdown"},
+            audience={"type": "all"},
+            notify_chat_id=update.effective_chat.id,
+            done_message="✅ Announcement sent to {sent} users!"
+        )
+        start_broadcast_job(context.bot, job)
+        
+        await update.message.reply_text(f"📤 Announcement queued as job #{job.id}. You'll get a summary when it's done.")
         logger.info(f"Admin sent announcement: {title}")
         
     except Exception as e:
@@ -1239,31 +1484,17 @@ async def sendto_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_level = int(context.args[0])
         message_text = ' '.join(context.args[1:])
         
-        users_ref = db.collection('users')
-        all_users = users_ref.stream()
-        
-        count = 0
-        bot = Bot(token=API_TOKEN)
-        
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            level = user_data.get('level_notified', 1)
-            
-            if level >= target_level:
-                chat_id = user_data.get('chat_id')
-                if chat_id:
-                    try:
-                        await bot.send_message(
-                            chat_id=chat_id,
-                            text=f"🔔 *Level {target_level}+ Message*\n\n{message_text}",
-                            parse_mode='Markdown'
-                        )
-                        count += 1
-                        await asyncio.sleep(0.1)
-                    except Exception as e:
-                        logger.error(f"Failed: {e}")
+        job = create_broadcast_job(
+            kind="sendto_level",
+            method="send_message",
+            kwargs={"text": f"🔔 *Level {target_level}+ Message*\n\n{message_text}", "parse_mode": "Markdown"},
+            audience={"type": "level", "min_level": target_level},
+            notify_chat_id=update.effective_chat.id,
+            done_message=f"✅ Message sent to {{sent}} users (level {target_level}+)"
+        )
+        start_broadcast_job(context.bot, job)
         
-        await update.message.reply_text(f"✅ Message sent to {count} users (level {target_level}+)")
+        await update.message.reply_text(f"📤 Level {target_level}+ message queued as job #{job.id}.")
         logger.info(f"Admin sent message to level {target_level}+ users")
         
     except ValueError:
@@ -1291,37 +1522,20 @@ async def sendto_active(update: Update, context: ContextTypes.DEFAULT_TYPE):
         days = int(context.args[0])
         message_text = ' '.join(context.args[1:])
         
-        now = datetime.utcnow()
-        cutoff_date = now - timedelta(days=days)
-        
-        users_ref = db.collection('users')
-        all_users = users_ref.stream()
+        # last_session_time est en millisecondes UTC
+        cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
         
-        count = 0
-        bot = Bot(token=API_TOKEN)
+        job = create_broadcast_job(
+            kind="sendto_active",
+            method="send_message",
+            kwargs={"text": f"🔔 *Active User Reward*\n\n{message_text}", "parse_mode": "Markdown"},
+            audience={"type": "active", "since_ms": int(cutoff_date.timestamp() * 1000)},
+            notify_chat_id=update.effective_chat.id,
+            done_message=f"✅ Message sent to {{sent}} active users (last {days} days)"
+        )
+        start_broadcast_job(context.bot, job)
         
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            last_session = user_data.get('last_session_time')
-            
-            if last_session:
-                try:
-                    if isinstance(last_session, int):
-                        last_session_date = datetime.utcfromtimestamp(last_session / 1000)
-                        if last_session_date >= cutoff_date:
-                            chat_id = user_data.get('chat_id')
-                            if chat_id:
-                                await bot.send_message(
-                                    chat_id=chat_id,
-                                    text=f"🔔 *Active User Reward*\n\n{message_text}",
-                                    parse_mode='Markdown'
-                                )
-                                count += 1
-                                await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Failed: {e}")
-        
-        await update.message.reply_text(f"✅ Message sent to {count} active users (last {days} days)")
+        await update.message.reply_text(f"📤 Active users message queued as job #{job.id}.")
         logger.info(f"Admin sent message to active users")
         
     except ValueError:
@@ -1372,27 +1586,25 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reason = ' '.join(context.args[1:])
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(target_username)
         
-        if not user_doc.exists:
+        if user_data is None:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
         # Marquer comme banni
-        user_doc_ref.update({
+        await repo.update_user(target_username, {
             "banned": True,
             "ban_reason": reason,
             "banned_at": firestore.SERVER_TIMESTAMP
         })
         
         # Notifier l'utilisateur
-        chat_id = user_doc.to_dict().get('chat_id')
+        chat_id = user_data.get('chat_id')
         if chat_id:
-            bot = Bot(token=API_TOKEN)
             ban_message = f"🚫 *Account Suspended*\n\nYour account has been suspended.\nReason: {reason}\n\nContact support for more information."
             try:
-                await bot.send_message(chat_id=chat_id, text=ban_message, parse_mode='Markdown')
+                await context.bot.send_message(chat_id=chat_id, text=ban_message, parse_mode='Markdown')
             except:
                 pass
         
@@ -1417,14 +1629,13 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_username = context.args[0]
     
     try:
-        user_doc_ref = db.collection('users').document(target_username)
-        user_doc = user_doc_ref.get()
+        user_data = await repo.get_user(target_username)
         
-        if not user_doc.exists:
+        if user_data is None:
             await update.message.reply_text(f"❌ User '{target_username}' not found.")
             return
         
-        user_doc_ref.update({
+        await repo.update_user(target_username, {
             "banned": False,
             "ban_reason": firestore.DELETE_FIELD,
             "unbanned_at": firestore.SERVER_TIMESTAMP
@@ -1480,11 +1691,25 @@ async def forcesync(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🔄 Force syncing all user data...")
         
         start_time = datetime.utcnow()
-        users_ref = db.collection('users')
-        all_users = list(users_ref.stream())
+        repo.cache.clear()
+        
+        if user_mirror:
+            # Recharger entièrement le miroir (et l'index qu'il alimente)
+            leaderboard_index.clear()
+            user_mirror.restart()
+            if not await user_mirror.wait_ready():
+                await update.message.reply_text(
+                    f"⚠️ Mirror reload not finished after {USER_MIRROR_LOAD_TIMEOUT:.0f}s "
+                    f"({len(user_mirror)} users loaded so far). It keeps loading in the background, try again later."
+                )
+                return
+            synced = len(user_mirror)
+        else:
+            # Simulation de sync (vérification que tous les documents sont accessibles)
+            all_users = [user async for user in iter_admin_users()]
+            synced = len(all_users)
         
-        # Simulation de sync (vérification que tous les documents sont accessibles)
-        synced = len(all_users)
+        await analytics.refresh()
         
         end_time = datetime.utcnow()
         duration = (end_time - start_time).total_seconds()
@@ -1547,34 +1772,46 @@ async def finduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         firestore_field = field_map.get(field, field)
         
-        users_ref = db.collection('users')
-        all_users = users_ref.stream()
-        
         results = []
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            user_value = user_data.get(firestore_field, 0)
-            
-            match = False
-            if operator == ">" and user_value > value:
-                match = True
-            elif operator == "=" and user_value == value:
-                match = True
-            elif operator == "<" and user_value < value:
-                match = True
-            
-            if match:
-                results.append(f"• {user_doc.id} - {firestore_field}: {user_value}")
+        if analytics.ready and firestore_field in SNAPSHOT_COLUMNS:
+            for username, user_value in analytics.snapshot.find(firestore_field, operator, value):
+                user_value = int(user_value) if float(user_value).is_integer() else float(user_value)
+                results.append(f"• {username} - {firestore_field}: {user_value}")
+            total_found = len(results)
+        elif user_mirror and user_mirror.ready:
+            for username, user_data in user_mirror.items():
+                user_value = user_data.get(firestore_field, 0)
+                
+                match = False
+                if operator == ">" and user_value > value:
+                    match = True
+                elif operator == "=" and user_value == value:
+                    match = True
+                elif operator == "<" and user_value < value:
+                    match = True
+                
+                if match:
+                    results.append(f"• {username} - {firestore_field}: {user_value}")
+            total_found = len(results)
+        else:
+            # Filtre côté serveur: seuls les users affichés sont lus, le total vient d'un count()
+            query_filter = (firestore_field, "==" if operator == "=" else operator, value)
+            total_found, page = await asyncio.gather(
+                repo.count_users(query_filter),
+                repo.get_users_where(*query_filter, limit=FINDUSER_LIMIT, fields=[firestore_field])
+            )
+            for username, user_data in page:
+                results.append(f"• {username} - {firestore_field}: {user_data.get(firestore_field)}")
         
         if not results:
             await update.message.reply_text("No users found matching criteria.")
             return
         
-        message = f"🔍 *Search Results* ({len(results)} found)\n\nCriteria: {criteria}\n\n"
-        message += "\n".join(results[:20])  # Limiter à 20 résultats
+        message = f"🔍 *Search Results* ({total_found} found)\n\nCriteria: {criteria}\n\n"
+        message += "\n".join(results[:FINDUSER_LIMIT])  # Limiter à 20 résultats
         
-        if len(results) > 20:
-            message += f"\n\n_...and {len(results) - 20} more_"
+        if total_found > FINDUSER_LIMIT:
+            message += f"\n\n_...and {total_found - FINDUSER_LIMIT} more_"
         
         await update.message.reply_text(message, parse_mode='Markdown')
         logger.info(f"Admin searched users: {criteria}")
@@ -1586,54 +1823,72 @@ async def finduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # 1️⃣5️⃣ EXPORT - Export de données
 async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Commande /export - Exporter les données en CSV"""
+    """Commande /export [csv|parquet] [gz] [since=last|<date>] - Exporter les données (CSV par défaut)"""
     if update.effective_user.username != ADMIN_USERNAME:
         await update.message.reply_text("❌ Permission denied.")
         return
     
+    options = [arg.lower() for arg in context.args or []]
+    export_format = next((arg for arg in options if arg in EXPORT_FORMATS), 'csv')
+    compress = 'gz' in options or 'gzip' in options
+    
+    # since=last (dernier export) ou since=<date ISO | timestamp>: seulement les users modifiés depuis
+    since_arg = next((arg.split('=', 1)[1] for arg in context.args or [] if arg.lower().startswith('since=')), None)
+    since = None
+    if since_arg:
+        try:
+            since = export_watermarks.get('users') if since_arg == 'last' else parse_watermark(since_arg)
+        except ValueError:
+            await update.message.reply_text("❌ since must be 'last', an ISO date or a Unix timestamp.")
+            return
+        if since is None:
+            await update.message.reply_text("❌ No previous export watermark, run a full /export first.")
+            return
+    
+    if export_format == 'parquet' and not parquet_available():
+        await update.message.reply_text("❌ Parquet export requires pyarrow on the server.")
+        return
+    
     try:
         await update.message.reply_text("📦 Preparing export...")
         
-        users_ref = db.collection('users')
-        all_users = list(users_ref.stream())
+        started_at = datetime.now(timezone.utc)
+        latest = []
         
-        # Créer CSV en mémoire
-        csv_buffer = io.StringIO()
-        csv_writer = csv.writer(csv_buffer)
+        async def changed_users():
+            # Lecture proportionnelle au nombre de users modifiés, pas à la taille de la collection
+            async for username, user_data in repo.iter_users_where(
+                    UPDATED_AT_FIELD, '>', since, fields=EXPORT_FIELDS + [UPDATED_AT_FIELD]):
+                latest[:] = [user_data.get(UPDATED_AT_FIELD)]
+                yield username, user_data
         
-        # Header
-        csv_writer.writerow([
-            'Username', 'User ID', 'Chat ID', 'Token Balance', 
-            'Level', 'Friends Invited', 'Claimed Days', 'Time on App (hours)'
-        ])
+        users = changed_users() if since else iter_admin_users(EXPORT_FIELDS)
         
-        # Data
-        for user_doc in all_users:
-            user_data = user_doc.to_dict()
-            time_hours = (user_data.get('time_on_app', 0) / 3600) if user_data.get('time_on_app') else 0
-            
-            csv_writer.writerow([
-                user_doc.id,
-                user_data.get('user_id', 'N/A'),
-                user_data.get('chat_id', 'N/A'),
-                user_data.get('token_balance', 0),
-                user_data.get('level_notified', 1),
-                user_data.get('friends_invited', 0),
-                user_data.get('claimedDay', 0),
-                f"{time_hours:.2f}"
-            ])
+        # Lignes écrites au fil du scan dans un fichier temporaire (mémoire bornée)
+        export_file, total, extension = await export_users(users, export_format, compress)
         
-        # Envoyer le fichier
-        csv_buffer.seek(0)
-        csv_bytes = csv_buffer.getvalue().encode('utf-8')
+        caption = f"📊 Export complete!\n\nTotal users: {total}"
+        if since:
+            # updated_at n'est posé que par les écritures du bot et de l'API, pas par le mini-app
+            caption = (
+                f"📊 Delta export complete!\n\nUsers changed since {since.strftime('%Y-%m-%d %H:%M')} UTC: {total}\n\n"
+                f"⚠️ Only changes made by the bot/API are tracked: balances, playtime and sessions "
+                f"updated by the mini-app are not included. Use a full /export for those."
+            )
         
-        await update.message.reply_document(
-            document=csv_bytes,
-            filename=f'tokearn_users_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
-            caption=f"📊 Export complete!\n\nTotal users: {len(all_users)}"
-        )
+        with export_file:
+            await update.message.reply_document(
+                document=export_file,
+                filename=f'tokearn_users_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}',
+                caption=caption
+            )
+        
+        # Prochain since=last: dernier updated_at exporté (delta), ou le début de l'export complet
+        watermark = latest[0] if since and latest and latest[0] else (None if since else started_at)
+        if watermark:
+            export_watermarks.set('users', watermark)
         
-        logger.info(f"Admin exported {len(all_users)} users")
+        logger.info(f"Admin exported {total} users ({extension})")
         
     except Exception as e:
         logger.error(f"Error: {e}")
@@ -1713,6 +1968,21 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await referral_link(update, context)
 
 
+# ========================================
+# ABONNEMENT AU CANAL
+# ========================================
+
+async def channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Met à jour le cache d'abonnement quand un user rejoint ou quitte le canal (bot admin du canal)"""
+    member_update = update.chat_member
+    if member_update.chat.username is None or f"@{member_update.chat.username}".lower() != CHANNEL_USERNAME.lower():
+        return
+
+    new_member = member_update.new_chat_member
+    membership_cache.set(new_member.user.id, is_member_status(new_member.status))
+    logger.info(f"Channel membership of {new_member.user.id} is now {new_member.status}")
+
+
 # ========================================
 # SYSTÈME DE PAIEMENT TELEGRAM STARS
 # ========================================
@@ -1779,11 +2049,22 @@ async def post_init(application):
     await application.bot.set_my_commands(public_commands)
     logger.info("Public bot commands configured")
     
+    # Charger le miroir mémoire des users en arrière-plan (commandes admin)
+    # En attendant le premier snapshot, les commandes admin scannent Firestore
+    if user_mirror:
+        user_mirror.start()
+        leaderboard_mirror.start()
+        analytics.start()
+    
+    # Reprendre les broadcasts interrompus
+    for job in job_store.pending():
+        logger.info(f"Resuming broadcast job #{job.id} ({job.kind})")
+        start_broadcast_job(application.bot, job)
+    
     try:
-        admin_doc = db.collection('users').document(ADMIN_USERNAME).get()
+        admin_data = await repo.get_user(ADMIN_USERNAME)
         
-        if admin_doc.exists:
-            admin_data = admin_doc.to_dict()
+        if admin_data is not None:
             admin_chat_id = admin_data.get('chat_id')
             
             if admin_chat_id:
@@ -1805,9 +2086,9 @@ async def post_init(application):
 # FONCTION PRINCIPALE
 # ========================================
 
-def main():
-    """Point d'entrée principal du bot"""
-    application = ApplicationBuilder().token(API_TOKEN).post_init(post_init).build()
+def build_application():
+    """Construit l'Application et enregistre tous les handlers"""
+    application = ApplicationBuilder().bot(telegram_bot).post_init(post_init).build()
 
     # COMMANDES PUBLIQUES
     application.add_handler(CommandHandler('start', start))
@@ -1836,17 +2117,34 @@ def main():
     application.add_handler(CommandHandler('ban', ban))
     application.add_handler(CommandHandler('unban', unban))
     application.add_handler(CommandHandler('maintenance', maintenance))
-    application.add_handler(CommandHandler('forcesync', forcesync))
+    # Rechargement long: ne bloque pas les updates des autres users
+    application.add_handler(CommandHandler('forcesync', forcesync, block=False))
     application.add_handler(CommandHandler('finduser', finduser))
     application.add_handler(CommandHandler('export', export))
     
     # CALLBACKS & PAIEMENTS
     application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") & filters.CaptionRegex(r'^/givecoins\b'), givecoins_csv
+    ))
     application.add_handler(PreCheckoutQueryHandler(pre_checkout_handler))
+    application.add_handler(ChatMemberHandler(channel_member_update, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 
+    return application
+
+
+def main():
+    """Point d'entrée principal du bot (mode polling)"""
+    if BOT_MODE == "webhook":
+        logger.error("BOT_MODE=webhook: updates are served by api.py, not starting polling")
+        return
+    
+    application = build_application()
+
     logger.info("Bot started with 20+ admin features! 🚀")
-    application.run_polling()
+    # chat_member n'est livré que si on le demande explicitement
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
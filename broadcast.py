@@ -0,0 +1,160 @@
+"""
+MOTEUR DE BROADCAST
+Envoi concurrent de messages sous les limites Telegram:
+~30 msg/s au global, 1 msg/s par chat, respect de RetryAfter
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30          # messages par seconde, tous chats confondus
+PER_CHAT_INTERVAL = 1.0   # secondes minimum entre deux messages au même chat
+DEFAULT_WORKERS = 16      # nombre d'envois concurrents
+MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Seau à jetons asynchrone: `rate` jetons par seconde, rafale max `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Attend qu'un jeton soit disponible puis le consomme"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Vide le seau et bloque les envois pendant `seconds` (flood control)"""
+        self._tokens = 0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+
+class ChatRateLimiter:
+    """Espace les messages destinés à un même chat d'au moins `interval` secondes"""
+
+    def __init__(self, interval=PER_CHAT_INTERVAL, max_entries=10_000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._next_allowed) > self.max_entries:
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+
+        slot = max(now, self._next_allowed.get(chat_id, now))
+        self._next_allowed[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class RateLimiter:
+    """Combine la limite globale et la limite par chat"""
+
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.bucket = TokenBucket(rate)
+        self.per_chat = ChatRateLimiter(per_chat_interval)
+
+    async def acquire(self, chat_id):
+        await self.per_chat.acquire(chat_id)
+        await self.bucket.acquire()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+
+# Limiteur partagé par tous les envois du process (le quota Telegram est par bot)
+limiter = RateLimiter()
+
+
+@dataclass
+class BroadcastResult:
+    sent: int = 0
+    failed: int = 0
+
+
+async def send_with_retry(chat_id, send, limiter=limiter):
+    """Envoie un message à un chat en respectant les limites. Retourne True si envoyé."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.acquire(chat_id)
+        try:
+            await send(chat_id)
+            return True
+        except RetryAfter as e:
+            logger.warning(f"Flood control hit, pausing {e.retry_after}s")
+            limiter.pause(e.retry_after)
+        except (Forbidden, BadRequest) as e:
+            # Bot bloqué, chat supprimé... inutile de réessayer
+            logger.error(f"Failed to send to chat_id {chat_id}: {e}")
+            return False
+        except NetworkError as e:
+            logger.warning(f"Network error for chat_id {chat_id} (attempt {attempt}): {e}")
+            await asyncio.sleep(attempt)
+        except Exception as e:
+            logger.error(f"Failed to send to chat_id {chat_id}: {e}")
+            return False
+
+    logger.error(f"Giving up on chat_id {chat_id} after {MAX_ATTEMPTS} attempts")
+    return False
+
+
+async def broadcast(chat_ids, send, workers=DEFAULT_WORKERS, limiter=limiter, on_result=None):
+    """
+    Envoie `send(chat_id)` à chaque chat de `chat_ids` (itérable sync ou async)
+    avec un pool de `workers` envois concurrents.
+    `on_result(chat_id, ok)` est appelé après chaque tentative.
+    """
+    result = BroadcastResult()
+    queue = asyncio.Queue(maxsize=workers * 2)
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                ok = await send_with_retry(chat_id, send, limiter)
+                if ok:
+                    result.sent += 1
+                else:
+                    result.failed += 1
+                if on_result:
+                    on_result(chat_id, ok)
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        if hasattr(chat_ids, '__aiter__'):
+            async for chat_id in chat_ids:
+                await queue.put(chat_id)
+        else:
+            for chat_id in chat_ids:
+                await queue.put(chat_id)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    logger.info(f"Broadcast finished: {result.sent} sent, {result.failed} failed")
+    return result
@@ -0,0 +1,183 @@
+"""
+EXPORT DES USERS
+Les lignes sont écrites au fil du scan dans un fichier temporaire (en mémoire
+jusqu'à EXPORT_SPOOL_MAX, puis sur disque): CSV, CSV gzip ou Parquet
+"""
+
+import csv
+import gzip
+import io
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from storage import open_state_db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet optionnel
+    pa = None
+    pq = None
+
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX", str(8 * 1024 * 1024)))
+PARQUET_CHUNK_SIZE = 5000  # lignes par row group
+CSV_FLUSH_ROWS = 1000      # lignes accumulées avant écriture dans le fichier
+
+EXPORT_HEADER = [
+    'Username', 'User ID', 'Chat ID', 'Token Balance',
+    'Level', 'Friends Invited', 'Claimed Days', 'Time on App (hours)'
+]
+
+EXPORT_FORMATS = ('csv', 'parquet')
+
+
+class ExportWatermarks:
+    """Dernier updated_at exporté, par nom d'export (SQLite)"""
+
+    def __init__(self, conn=None):
+        self.conn = conn or open_state_db()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS export_watermarks (
+                name TEXT PRIMARY KEY,
+                watermark REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def get(self, name):
+        """Watermark en datetime UTC, ou None si aucun export n'a été fait"""
+        row = self.conn.execute("SELECT watermark FROM export_watermarks WHERE name = ?", (name,)).fetchone()
+        return datetime.fromtimestamp(row["watermark"], tz=timezone.utc) if row else None
+
+    def set(self, name, watermark):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO export_watermarks (name, watermark, updated_at) VALUES (?, ?, ?)",
+            (name, watermark.timestamp(), time.time())
+        )
+
+
+def parse_watermark(value):
+    """'2026-10-17', '2026-10-17T08:00' (UTC par défaut) ou timestamp Unix -> datetime UTC"""
+    try:
+        return datetime.fromtimestamp(float(value), tz=timezone.utc)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parquet_available():
+    return pq is not None
+
+
+def _csv_row(username, user_data):
+    time_hours = (user_data.get('time_on_app', 0) / 3600) if user_data.get('time_on_app') else 0
+    return [
+        username,
+        user_data.get('user_id', 'N/A'),
+        user_data.get('chat_id', 'N/A'),
+        user_data.get('token_balance', 0),
+        user_data.get('level_notified', 1),
+        user_data.get('friends_invited', 0),
+        user_data.get('claimedDay', 0),
+        f"{time_hours:.2f}"
+    ]
+
+
+def _number(value, cast):
+    """Valeur numérique typée pour Parquet (None si absente ou invalide)"""
+    try:
+        return cast(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+async def write_csv(users, fileobj, compress=False):
+    """Écrit les (username, data) de l'itérable async `users` en CSV. Retourne le nombre de lignes."""
+    target = gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else fileobj
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        target.write(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+
+    writer.writerow(EXPORT_HEADER)
+    count = 0
+    try:
+        async for username, user_data in users:
+            writer.writerow(_csv_row(username, user_data))
+            count += 1
+            if count % CSV_FLUSH_ROWS == 0:
+                flush()
+        flush()
+    finally:
+        if compress:
+            target.close()  # termine le flux gzip sans fermer `fileobj`
+    return count
+
+
+async def write_parquet(users, fileobj, compress=False):
+    """Écrit les users en Parquet, par row groups de PARQUET_CHUNK_SIZE lignes"""
+    schema = pa.schema([
+        ('username', pa.string()),
+        ('user_id', pa.int64()),
+        ('chat_id', pa.int64()),
+        ('token_balance', pa.float64()),
+        ('level', pa.int64()),
+        ('friends_invited', pa.int64()),
+        ('claimed_days', pa.int64()),
+        ('time_on_app_hours', pa.float64()),
+    ])
+    writer = pq.ParquetWriter(fileobj, schema, compression='gzip' if compress else 'snappy')
+    chunk = []
+    count = 0
+
+    def flush():
+        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+        chunk.clear()
+
+    try:
+        async for username, user_data in users:
+            time_on_app = _number(user_data.get('time_on_app'), float)
+            chunk.append({
+                'username': username,
+                'user_id': _number(user_data.get('user_id'), int),
+                'chat_id': _number(user_data.get('chat_id'), int),
+                'token_balance': _number(user_data.get('token_balance', 0), float),
+                'level': _number(user_data.get('level_notified', 1), int),
+                'friends_invited': _number(user_data.get('friends_invited', 0), int),
+                'claimed_days': _number(user_data.get('claimedDay', 0), int),
+                'time_on_app_hours': time_on_app / 3600 if time_on_app else 0.0,
+            })
+            count += 1
+            if len(chunk) >= PARQUET_CHUNK_SIZE:
+                flush()
+        if chunk:
+            flush()
+    finally:
+        writer.close()
+    return count
+
+
+async def export_users(users, export_format='csv', compress=False):
+    """
+    Exporte les users dans un fichier temporaire rembobiné.
+    Retourne (fichier, nombre de lignes, extension); l'appelant ferme le fichier.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    try:
+        if export_format == 'parquet':
+            count = await write_parquet(users, spool, compress)
+            extension = 'parquet'
+        else:
+            count = await write_csv(users, spool, compress)
+            extension = 'csv.gz' if compress else 'csv'
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, count, extension
@@ -0,0 +1,232 @@
+"""
+MOTEUR DE DONS DE TOKENS
+Résout tous les bénéficiaires en une lecture groupée, applique tous les
+incréments dans un seul WriteBatch, puis envoie les notifications en parallèle.
+Les dons en masse (CSV) passent par le BulkWriter Firestore.
+"""
+
+import asyncio
+import csv
+import io
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+from google.rpc import code_pb2
+
+from broadcast import broadcast
+from repository import USERS_COLLECTION, touched
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Grant:
+    username: str
+    amount: int
+    # Notification: kwargs de send_message (text, parse_mode, ...), None = pas de message
+    notification: Optional[Dict] = None
+    reason: str = ''
+
+
+@dataclass
+class GrantResult:
+    applied: List[Grant] = field(default_factory=list)
+    missing: List[str] = field(default_factory=list)
+    notified: int = 0
+    notify_failed: int = 0
+
+
+async def apply_grants(repo, bot, grants, balance_field='token_balance'):
+    """
+    Crédite chaque Grant puis notifie les bénéficiaires.
+    Les users inexistants sont ignorés (GrantResult.missing); les autres sont
+    crédités ensemble ou pas du tout.
+    """
+    result = GrantResult()
+    users = await repo.get_users([grant.username for grant in grants])
+
+    increments = {}
+    for grant in grants:
+        if users.get(grant.username) is None:
+            result.missing.append(grant.username)
+            continue
+        increments[grant.username] = increments.get(grant.username, 0) + grant.amount
+        result.applied.append(grant)
+
+    if increments:
+        await repo.increment_users(increments, balance_field)
+        logger.info(f"Granted {sum(increments.values())} to {len(increments)} users in one batch")
+
+    recipients = [(grant, users[grant.username].get('chat_id')) for grant in result.applied]
+    sent = await notify_grants(bot, recipients)
+    result.notified, result.notify_failed = sent.sent, sent.failed
+    return result
+
+
+def merge_notifications(notifications):
+    """
+    Regroupe les notifications destinées à un même chat: les textes consécutifs de même
+    parse_mode sont fusionnés en un message (premier reply_markup conservé)
+    """
+    merged = []
+    for notification in notifications:
+        last = merged[-1] if merged else None
+        if last is not None and last.get('parse_mode') == notification.get('parse_mode'):
+            last['text'] = f"{last['text'].rstrip()}\n\n{notification['text'].strip()}"
+            if 'reply_markup' not in last and 'reply_markup' in notification:
+                last['reply_markup'] = notification['reply_markup']
+        else:
+            merged.append(dict(notification))
+    return merged
+
+
+async def notify_grants(bot, recipients):
+    """
+    Envoie la notification de chaque (Grant, chat_id) en parallèle, sous les limites Telegram.
+    Plusieurs dons vers un même chat partent en un seul message.
+    """
+    # chat_id -> messages restant à envoyer
+    messages = {}
+    for grant, chat_id in recipients:
+        if grant.notification and chat_id:
+            messages.setdefault(chat_id, []).append(grant.notification)
+    messages = {chat_id: merge_notifications(notifications) for chat_id, notifications in messages.items()}
+
+    async def send(chat_id):
+        # Retiré une fois envoyé: un retry ne renvoie pas les messages déjà partis
+        pending = messages[chat_id]
+        while pending:
+            await bot.send_message(chat_id=chat_id, **pending[0])
+            pending.pop(0)
+
+    return await broadcast(list(messages), send)
+
+
+# ========================================
+# DONS EN MASSE (CSV)
+# ========================================
+
+BULK_LOOKUP_SIZE = 300   # usernames par get_all
+BULK_MAX_ATTEMPTS = 5    # tentatives du BulkWriter par document
+
+
+@dataclass
+class BulkGrantProgress:
+    total: int = 0
+    validated: int = 0
+    written: int = 0
+    failures: List[List] = field(default_factory=list)  # [username, amount, reason, erreur]
+
+
+def parse_grants_csv(data):
+    """
+    Lit un CSV username,amount,reason (en-tête optionnel).
+    Retourne ({username: Grant}, failures); les lignes d'un même username sont cumulées.
+    """
+    grants = {}
+    failures = []
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline=''))
+    for line_number, row in enumerate(reader, 1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        username = row[0].strip()
+        raw_amount = row[1].strip() if len(row) > 1 else ''
+        reason = row[2].strip() if len(row) > 2 else ''
+        if line_number == 1 and username.lower() == 'username':
+            continue
+        try:
+            amount = int(raw_amount)
+        except ValueError:
+            failures.append([username, raw_amount, reason, 'Invalid amount'])
+            continue
+        if not username or amount <= 0:
+            failures.append([username, raw_amount, reason, 'Missing username or non-positive amount'])
+            continue
+
+        grant = grants.get(username)
+        if grant is None:
+            grants[username] = Grant(username, amount, reason=reason)
+        else:
+            grant.amount += amount
+            if reason and reason not in grant.reason:
+                grant.reason = f"{grant.reason}; {reason}" if grant.reason else reason
+    return grants, failures
+
+
+def bulk_increment(client, increments, progress, reasons=None, balance_field='token_balance'):
+    """
+    Applique {username: montant} via BulkWriter (débit auto-régulé par Firestore).
+    `reasons` ({username: raison}) est recopié dans les lignes d'échec.
+    Bloquant: à lancer dans un thread. Met à jour `progress` au fil des écritures.
+    Retourne l'ensemble des usernames dont l'écriture a échoué.
+    """
+    lock = threading.Lock()
+    failed = set()
+    users = client.collection(USERS_COLLECTION)
+
+    def on_result(reference, result, bulk_writer):
+        with lock:
+            progress.written += 1
+
+    def on_error(error, bulk_writer):
+        # Document supprimé entre-temps: inutile de réessayer
+        if error.attempts < BULK_MAX_ATTEMPTS and error.code not in (code_pb2.NOT_FOUND, code_pb2.FAILED_PRECONDITION):
+            return True
+        username = error.operation.reference.id
+        with lock:
+            failed.add(username)
+            reason = (reasons or {}).get(username, '')
+            progress.failures.append([username, increments[username], reason, f"Write failed: {error.message}"])
+        return False
+
+    writer = client.bulk_writer()
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+    for username, amount in increments.items():
+        writer.update(users.document(username), touched({balance_field: firestore.Increment(amount)}))
+    writer.close()
+    return failed
+
+
+async def bulk_apply_grants(repo, client, grants, progress):
+    """
+    Valide les usernames par get_all groupés puis crédite via BulkWriter.
+    Retourne la liste des Grants crédités avec le chat_id de chaque bénéficiaire.
+    """
+    progress.total = len(grants)
+    valid = []
+    usernames = list(grants)
+    for start in range(0, len(usernames), BULK_LOOKUP_SIZE):
+        chunk = usernames[start:start + BULK_LOOKUP_SIZE]
+        users = await repo.get_users(chunk)
+        for username in chunk:
+            grant = grants[username]
+            user_data = users.get(username)
+            if user_data is None:
+                progress.failures.append([username, grant.amount, grant.reason, 'User not found'])
+            else:
+                valid.append((grant, user_data.get('chat_id')))
+        progress.validated += len(chunk)
+
+    increments = {grant.username: grant.amount for grant, _ in valid}
+    reasons = {grant.username: grant.reason for grant, _ in valid}
+    try:
+        failed = await asyncio.to_thread(bulk_increment, client, increments, progress, reasons)
+    finally:
+        for username in increments:
+            repo.invalidate(username)
+
+    # Seuls les échecs d'écriture comptent: progress.failures contient aussi les rejets du CSV
+    return [(grant, chat_id) for grant, chat_id in valid if grant.username not in failed]
+
+
+def failures_csv(failures):
+    """Fichier CSV des lignes rejetées"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['username', 'amount', 'reason', 'error'])
+    writer.writerows(failures)
+    return buffer.getvalue().encode('utf-8')
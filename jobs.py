@@ -0,0 +1,209 @@
+"""
+JOBS DE BROADCAST PERSISTANTS
+Chaque broadcast est enregistré comme un job avec son curseur d'audience
+et la liste des chat_id déjà servis, pour reprendre après un crash/redémarrage
+"""
+
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+from broadcast import broadcast as run_broadcast
+from storage import open_state_db
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_BACKEND = os.getenv("JOB_STORE_BACKEND", "sqlite")
+PAGE_SIZE = 500
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+@dataclass
+class BroadcastJob:
+    id: int
+    kind: str
+    payload: dict
+    audience: dict
+    cursor: str = None
+    status: str = STATUS_RUNNING
+    sent: int = 0
+    failed: int = 0
+    created_at: float = field(default_factory=time.time)
+
+
+class JobStore(ABC):
+    """Interface des backends de stockage des jobs"""
+
+    @abstractmethod
+    def create(self, kind, payload, audience):
+        ...
+
+    @abstractmethod
+    def get(self, job_id):
+        ...
+
+    @abstractmethod
+    def pending(self):
+        ...
+
+    @abstractmethod
+    def delivered(self, job_id):
+        ...
+
+    @abstractmethod
+    def mark_delivered(self, job_id, chat_id):
+        ...
+
+    @abstractmethod
+    def checkpoint(self, job_id, cursor, sent, failed):
+        ...
+
+    @abstractmethod
+    def finish(self, job_id, status=STATUS_DONE):
+        ...
+
+
+class SQLiteJobStore(JobStore):
+    """Backend SQLite local"""
+
+    def __init__(self, conn=None):
+        self.conn = conn or open_state_db()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                audience TEXT NOT NULL,
+                cursor TEXT,
+                status TEXT NOT NULL,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                PRIMARY KEY (job_id, chat_id)
+            );
+        """)
+
+    def _to_job(self, row):
+        return BroadcastJob(
+            id=row["id"],
+            kind=row["kind"],
+            payload=json.loads(row["payload"]),
+            audience=json.loads(row["audience"]),
+            cursor=row["cursor"],
+            status=row["status"],
+            sent=row["sent"],
+            failed=row["failed"],
+            created_at=row["created_at"],
+        )
+
+    def create(self, kind, payload, audience):
+        now = time.time()
+        cur = self.conn.execute(
+            "INSERT INTO broadcast_jobs (kind, payload, audience, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), json.dumps(audience), STATUS_RUNNING, now, now)
+        )
+        return self.get(cur.lastrowid)
+
+    def get(self, job_id):
+        row = self.conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def pending(self):
+        rows = self.conn.execute(
+            "SELECT * FROM broadcast_jobs WHERE status = ? ORDER BY id", (STATUS_RUNNING,)
+        ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def delivered(self, job_id):
+        rows = self.conn.execute("SELECT chat_id FROM broadcast_deliveries WHERE job_id = ?", (job_id,))
+        return {row["chat_id"] for row in rows}
+
+    def mark_delivered(self, job_id, chat_id):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO broadcast_deliveries (job_id, chat_id) VALUES (?, ?)",
+            (job_id, int(chat_id))
+        )
+
+    def checkpoint(self, job_id, cursor, sent, failed):
+        self.conn.execute(
+            "UPDATE broadcast_jobs SET cursor = ?, sent = ?, failed = ?, updated_at = ? WHERE id = ?",
+            (cursor, sent, failed, time.time(), job_id)
+        )
+
+    def finish(self, job_id, status=STATUS_DONE):
+        self.conn.execute(
+            "UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE id = ?",
+            (status, time.time(), job_id)
+        )
+        # Les livraisons ne servent plus qu'à la reprise
+        self.conn.execute("DELETE FROM broadcast_deliveries WHERE job_id = ?", (job_id,))
+
+
+JOB_STORE_BACKENDS = {
+    "sqlite": SQLiteJobStore,
+}
+
+
+def get_job_store(backend=JOB_STORE_BACKEND):
+    """Instancie le backend configuré (JOB_STORE_BACKEND)"""
+    try:
+        return JOB_STORE_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown job store backend: {backend}")
+
+
+async def run_job(store, job, fetch_page, send):
+    """
+    Exécute (ou reprend) un job page par page.
+    `fetch_page(audience, cursor, limit)` retourne [(position, chat_id), ...] dans l'ordre de
+    parcours (position = curseur texte à repasser pour lire la suite), `send(chat_id)` envoie
+    le message. Le curseur avance après chaque page terminée.
+    """
+    delivered = store.delivered(job.id)
+    cursor = job.cursor
+    sent, failed = job.sent, job.failed
+
+    if cursor or delivered:
+        logger.info(f"Resuming broadcast job #{job.id} after '{cursor}' ({len(delivered)} already delivered)")
+
+    def record(chat_id, ok):
+        if ok:
+            store.mark_delivered(job.id, chat_id)
+            delivered.add(chat_id)
+
+    try:
+        while True:
+            page = await fetch_page(job.audience, cursor, PAGE_SIZE)
+            if not page:
+                break
+
+            chat_ids = [chat_id for _, chat_id in page if chat_id and chat_id not in delivered]
+            result = await run_broadcast(chat_ids, send, on_result=record)
+            sent += result.sent
+            failed += result.failed
+
+            cursor = page[-1][0]
+            store.checkpoint(job.id, cursor, sent, failed)
+
+            if len(page) < PAGE_SIZE:
+                break
+    except Exception as e:
+        logger.error(f"Broadcast job #{job.id} interrupted at '{cursor}': {e}")
+        raise
+
+    store.finish(job.id)
+    job.cursor, job.sent, job.failed, job.status = cursor, sent, failed, STATUS_DONE
+    logger.info(f"Broadcast job #{job.id} done: {sent} sent, {failed} failed")
+    return job
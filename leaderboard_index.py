@@ -0,0 +1,171 @@
+"""
+INDEX DU LEADERBOARD
+Structure ordonnée (token_balance décroissant, username) mise à jour à chaque
+changement de solde: top N et rang exact de n'importe quel user en O(log n)
+"""
+
+import random
+import threading
+
+MAX_LEVELS = 24
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        # width[i] = nombre de positions jusqu'au noeud next[i]
+        self.width = [1] * levels
+
+
+class RankedList:
+    """Skip list indexable: insertion, suppression et rang en O(log n) (espérance)"""
+
+    def __init__(self):
+        self.head = _Node(None, MAX_LEVELS)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _random_level(self):
+        level = 1
+        while level < MAX_LEVELS and random.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key):
+        chain = [None] * MAX_LEVELS
+        steps_at_level = [0] * MAX_LEVELS
+        node = self.head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = self._random_level()
+        new_node = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * MAX_LEVELS
+        node = self.head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Position 1-based de `key`, ou None si absente"""
+        node = self.head
+        position = 0
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        candidate = node.next[0]
+        if candidate is None or candidate.key != key:
+            return None
+        return position + 1
+
+    def first(self, n):
+        """Les `n` premières clés"""
+        keys = []
+        node = self.head.next[0]
+        while node is not None and len(keys) < n:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class LeaderboardIndex:
+    """Classement des users par token_balance, alimenté de façon incrémentale"""
+
+    def __init__(self):
+        self._entries = {}  # username -> (token_balance, level)
+        self._ranked = RankedList()
+        self._lock = threading.Lock()
+        self.version = 0
+
+    @staticmethod
+    def _key(username, balance):
+        return (-balance, username)
+
+    def update(self, username, user_data):
+        """Applique un changement de document user (user_data=None si supprimé)"""
+        if user_data is None:
+            self.remove(username)
+            return
+
+        balance = user_data.get('token_balance', 0)
+        if not isinstance(balance, (int, float)):
+            balance = 0
+        level = user_data.get('level_notified', 1)
+
+        with self._lock:
+            previous = self._entries.get(username)
+            if previous == (balance, level):
+                return
+            if previous is not None:
+                self._ranked.remove(self._key(username, previous[0]))
+            self._ranked.insert(self._key(username, balance))
+            self._entries[username] = (balance, level)
+            self.version += 1
+
+    def remove(self, username):
+        with self._lock:
+            previous = self._entries.pop(username, None)
+            if previous is not None:
+                self._ranked.remove(self._key(username, previous[0]))
+                self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._ranked = RankedList()
+            self.version += 1
+
+    def top(self, n):
+        """Les n premiers: [{rank, username, token_balance, level}, ...]"""
+        with self._lock:
+            entries = []
+            for rank, (_, username) in enumerate(self._ranked.first(n), 1):
+                balance, level = self._entries[username]
+                entries.append({"rank": rank, "username": username, "token_balance": balance, "level": level})
+            return entries
+
+    def rank(self, username):
+        """Rang exact du user (1-based), ou None s'il n'est pas indexé"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            return self._ranked.rank(self._key(username, entry[0]))
+
+    def __len__(self):
+        return len(self._entries)
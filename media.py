@@ -0,0 +1,72 @@
+"""
+REGISTRE DES MÉDIAS TELEGRAM
+Chaque GIF récurrent est envoyé une fois par URL, puis réutilisé via son file_id
+(persisté en SQLite): Telegram n'a plus à retélécharger l'URL à chaque envoi
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest
+
+from storage import open_state_db
+
+logger = logging.getLogger(__name__)
+
+
+class MediaRegistry:
+    """URL -> file_id Telegram"""
+
+    def __init__(self, conn=None):
+        self.conn = conn or open_state_db()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_files (
+                url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        rows = self.conn.execute("SELECT url, file_id FROM media_files").fetchall()
+        self._file_ids = {row["url"]: row["file_id"] for row in rows}
+        self._locks = {}
+
+    def get(self, url):
+        return self._file_ids.get(url)
+
+    def remember(self, url, file_id):
+        self._file_ids[url] = file_id
+        self.conn.execute(
+            "INSERT OR REPLACE INTO media_files (url, file_id, updated_at) VALUES (?, ?, ?)",
+            (url, file_id, time.time())
+        )
+        logger.info(f"Registered file_id for {url}")
+
+    def forget(self, url):
+        self._file_ids.pop(url, None)
+        self.conn.execute("DELETE FROM media_files WHERE url = ?", (url,))
+
+    async def send_animation(self, bot, chat_id, url, **kwargs):
+        """send_animation via le file_id connu, sinon envoie l'URL une fois et enregistre le file_id"""
+        file_id = self._file_ids.get(url)
+        if file_id:
+            try:
+                return await bot.send_animation(chat_id=chat_id, animation=file_id, **kwargs)
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logger.warning(f"Stale file_id for {url}, uploading again: {e}")
+                self.forget(url)
+
+        # Un seul envoi par URL à la fois: les autres attendent le file_id
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(url)
+            if file_id:
+                return await bot.send_animation(chat_id=chat_id, animation=file_id, **kwargs)
+
+            message = await bot.send_animation(chat_id=chat_id, animation=url, **kwargs)
+            media = message.animation or message.document or message.video
+            if media:
+                self.remember(url, media.file_id)
+            return message
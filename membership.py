@@ -0,0 +1,162 @@
+"""
+VÉRIFICATION D'ABONNEMENT AU CANAL
+Service interne appelé directement par les routes d'api.py: un seul appel
+Telegram get_chat_member, sans repasser par HTTP
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from cachetools import TLRUCache
+from telegram.error import RetryAfter, TelegramError
+
+from broadcast import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_USERNAME = "@pxlonton"  # Canal à rejoindre pour la quête
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+MEMBERSHIP_BATCH_MAX = int(os.getenv("MEMBERSHIP_BATCH_MAX", "500"))
+MEMBERSHIP_BATCH_CONCURRENCY = int(os.getenv("MEMBERSHIP_BATCH_CONCURRENCY", "16"))
+MEMBERSHIP_CHECK_RATE = float(os.getenv("MEMBERSHIP_CHECK_RATE", "20"))  # get_chat_member par seconde
+MAX_ATTEMPTS = 3
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "600"))
+# Un non-membre peut rejoindre d'une seconde à l'autre: on le revérifie vite
+MEMBERSHIP_CACHE_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", "10"))
+# Sans updates chat_member dans le process (polling: elles arrivent au dyno worker),
+# un départ du canal n'est vu qu'à l'expiration: TTL positif court
+MEMBERSHIP_CACHE_POLLING_TTL = float(os.getenv("MEMBERSHIP_CACHE_POLLING_TTL", "30"))
+
+
+class MembershipCache:
+    """Cache user_id -> membre ou non, mis à jour aussi par les updates chat_member"""
+
+    def __init__(self, maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL,
+                 negative_ttl=MEMBERSHIP_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TLRUCache(maxsize=maxsize, ttu=self._ttu, timer=time.monotonic)
+        self.hits = 0
+        self.misses = 0
+
+    def _ttu(self, key, value, now):
+        return now + (self.ttl if value else self.negative_ttl)
+
+    def get(self, user_id):
+        """Retourne True/False, ou None si inconnu ou expiré"""
+        value = self._cache.get(int(user_id))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, user_id, is_member):
+        self._cache[int(user_id)] = bool(is_member)
+
+    def invalidate(self, user_id):
+        self._cache.pop(int(user_id), None)
+
+
+# Partagé par le bot (handler chat_member) et api.py quand ils tournent dans le même process
+# (BOT_MODE=webhook). En polling, api.py utilise un cache à TTL court (MEMBERSHIP_CACHE_POLLING_TTL).
+membership_cache = MembershipCache()
+
+
+def is_member_status(status):
+    return status in MEMBER_STATUSES
+
+
+class MembershipError(Exception):
+    """Vérification impossible pour ce user (status HTTP à renvoyer)"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class MembershipService:
+    """Vérifie qu'un user (par username) est abonné au canal"""
+
+    def __init__(self, repo, bot, channel=CHANNEL_USERNAME, cache=None, rate=MEMBERSHIP_CHECK_RATE):
+        self.repo = repo
+        self.bot = bot
+        self.channel = channel
+        self.cache = cache or membership_cache
+        self.bucket = TokenBucket(rate)
+
+    async def get_user_id(self, username):
+        user_data = await self.repo.get_user(username)
+        if user_data is None:
+            raise MembershipError('User not found', 404)
+
+        user_id = user_data.get('user_id')
+        if not user_id:
+            raise MembershipError('User ID not found', 400)
+        return int(user_id)
+
+    async def is_member(self, username):
+        """True si le user est membre du canal. Les erreurs Telegram remontent telles quelles."""
+        user_id = await self.get_user_id(username)
+        is_member = await self.check_user_id(user_id)
+        logger.info(f"User '{username}' is_member={is_member}")
+        return is_member
+
+    async def check_user_id(self, user_id):
+        """Statut d'un user_id (cache, sinon get_chat_member sous le rate limit)"""
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.bucket.acquire()
+            try:
+                member = await self.bot.get_chat_member(chat_id=self.channel, user_id=int(user_id))
+                break
+            except RetryAfter as e:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Flood control on get_chat_member, pausing {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+
+        is_member = is_member_status(member.status)
+        self.cache.set(user_id, is_member)
+        return is_member
+
+    async def check_many(self, usernames=(), user_ids=(), concurrency=MEMBERSHIP_BATCH_CONCURRENCY):
+        """Vérifie un lot de usernames et/ou user_ids. Produit les résultats au fil de l'eau."""
+        users = await self.repo.get_users(list(usernames)) if usernames else {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def check(key, value, user_id):
+            result = {key: value}
+            if user_id is None:
+                result['error'] = 'User not found' if users.get(value) is None else 'User ID not found'
+                return result
+            try:
+                async with semaphore:
+                    result['isMember'] = await self.check_user_id(user_id)
+            except TelegramError as e:
+                result['error'] = str(e)
+            except (TypeError, ValueError):
+                result['error'] = 'Invalid user ID'
+            return result
+
+        tasks = []
+        for username in dict.fromkeys(usernames):
+            user_data = users.get(username) or {}
+            tasks.append(asyncio.ensure_future(check('username', username, user_data.get('user_id') or None)))
+        for user_id in dict.fromkeys(user_ids):
+            tasks.append(asyncio.ensure_future(check('userId', user_id, user_id)))
+
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
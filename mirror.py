@@ -0,0 +1,99 @@
+"""
+MIROIRS MÉMOIRE DE COLLECTIONS FIRESTORE
+Chargés une fois au démarrage puis tenus à jour par un listener on_snapshot.
+Les commandes admin (users) et le leaderboard (mainleaderboard) lisent ces
+miroirs au lieu de rescanner les collections.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Actif par défaut: le miroir users alimente aussi l'index du leaderboard (rang de chaque user).
+# Coût mémoire: ~1 Ko par user (+ ~0,2 Ko dans l'index), soit ~120 Mo pour 100k users.
+# USER_MIRROR_ENABLED=false sur un petit dyno: rang seulement pour le top du classement matérialisé.
+USER_MIRROR_ENABLED = os.getenv("USER_MIRROR_ENABLED", "true").lower() in ("1", "true", "yes")
+USER_MIRROR_LOAD_TIMEOUT = float(os.getenv("USER_MIRROR_LOAD_TIMEOUT", "120"))
+
+
+class CollectionMirror:
+    """Copie mémoire ID de document -> données, alimentée par on_snapshot (thread Firestore)"""
+
+    def __init__(self, collection_ref):
+        self.collection_ref = collection_ref
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._listeners = []
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def add_listener(self, callback):
+        """callback(doc_id, data) appelé à chaque changement (data=None si supprimé)"""
+        self._listeners.append(callback)
+
+    def start(self):
+        """Démarre le listener; le premier snapshot charge toute la collection"""
+        self._ready.clear()
+        self._watch = self.collection_ref.on_snapshot(self._on_snapshot)
+        logger.info(f"Mirror listener started for '{self.collection_ref.id}'")
+
+    def stop(self):
+        if self._watch:
+            self._watch.unsubscribe()
+            self._watch = None
+        self._ready.clear()
+
+    def restart(self):
+        """Repart de zéro (nouveau chargement complet)"""
+        self.stop()
+        with self._lock:
+            self._docs = {}
+        self.start()
+
+    async def wait_ready(self, timeout=USER_MIRROR_LOAD_TIMEOUT):
+        """Attend le premier snapshot sans bloquer la boucle"""
+        return await asyncio.to_thread(self._ready.wait, timeout)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        updated = []
+        with self._lock:
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    self._docs.pop(doc_id, None)
+                    updated.append((doc_id, None))
+                else:
+                    data = change.document.to_dict()
+                    self._docs[doc_id] = data
+                    updated.append((doc_id, data))
+
+        for doc_id, data in updated:
+            for callback in self._listeners:
+                try:
+                    callback(doc_id, data)
+                except Exception as e:
+                    logger.error(f"Mirror listener failed for {doc_id}: {e}")
+
+        if not self._ready.is_set():
+            logger.info(f"Mirror loaded for '{self.collection_ref.id}': {len(self._docs)} documents")
+            self._ready.set()
+
+    def get(self, doc_id):
+        with self._lock:
+            data = self._docs.get(doc_id)
+        return dict(data) if data is not None else None
+
+    def items(self):
+        """Instantané [(doc_id, data), ...] de tout le miroir"""
+        with self._lock:
+            return list(self._docs.items())
+
+    def __len__(self):
+        return len(self._docs)
@@ -0,0 +1,239 @@
+"""
+OUTBOX DES NOTIFICATIONS
+Les routes d'api.py enregistrent la notification (SQLite) et répondent tout de suite;
+un pool de workers la rend et l'envoie ensuite, avec retries, backoff et limite par chat.
+Les notifications d'un même destinataire arrivées dans la fenêtre de regroupement
+partent en un seul message récapitulatif.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from telegram.error import Forbidden, BadRequest, RetryAfter
+
+from broadcast import limiter as default_limiter
+from storage import open_state_db
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BASE_DELAY = 2.0      # secondes, doublé à chaque tentative
+OUTBOX_MAX_DELAY = 300.0
+OUTBOX_POLL_INTERVAL = 5.0   # filet de sécurité si un réveil est manqué
+# Délai avant envoi pendant lequel les notifications d'un même destinataire s'accumulent
+OUTBOX_COALESCE_WINDOW = float(os.getenv("OUTBOX_COALESCE_WINDOW", "10"))
+
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+STATUS_FAILED = "failed"
+
+
+class Undeliverable(Exception):
+    """Levée par un renderer quand le destinataire n'existe pas: message gardé en échec"""
+
+
+@dataclass
+class OutboxMessage:
+    id: int
+    kind: str
+    recipient: str
+    payload: dict
+    attempts: int = 0
+
+
+@dataclass
+class Notification:
+    """Message prêt à envoyer: chat_id + arguments de send_message"""
+    chat_id: int
+    kwargs: dict
+
+
+class Outbox:
+    """File de notifications persistée en SQLite"""
+
+    def __init__(self, conn=None):
+        self.conn = conn or open_state_db()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        # Les messages en cours d'envoi lors d'un arrêt brutal sont rejoués
+        self.conn.execute(
+            "UPDATE notification_outbox SET status = ? WHERE status = ?", (STATUS_PENDING, STATUS_SENDING)
+        )
+        self._wakeup = None
+
+    def _to_message(self, row):
+        return OutboxMessage(
+            id=row["id"],
+            kind=row["kind"],
+            recipient=row["recipient"],
+            payload=json.loads(row["payload"]),
+            attempts=row["attempts"],
+        )
+
+    def enqueue(self, kind, recipient, payload, delay=OUTBOX_COALESCE_WINDOW):
+        now = time.time()
+        cur = self.conn.execute(
+            "INSERT INTO notification_outbox (kind, recipient, payload, status, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, recipient, json.dumps(payload), STATUS_PENDING, now + delay, now)
+        )
+        if self._wakeup:
+            self._wakeup.set()
+        return cur.lastrowid
+
+    def claim(self, limit):
+        """
+        Réserve les messages dus de jusqu'à `limit` destinataires, dans l'ordre d'arrivée.
+        Retourne une liste de groupes: tous les messages dus d'un même destinataire.
+        """
+        now = time.time()
+        recipients = [row["recipient"] for row in self.conn.execute(
+            "SELECT recipient FROM notification_outbox WHERE status = ? AND next_attempt_at <= ? "
+            "GROUP BY recipient ORDER BY MIN(id) LIMIT ?",
+            (STATUS_PENDING, now, limit)
+        )]
+        if not recipients:
+            return []
+
+        # Seuls les messages dus sont regroupés: ceux en backoff attendent leur tour
+        placeholders = ", ".join("?" * len(recipients))
+        rows = self.conn.execute(
+            f"SELECT * FROM notification_outbox WHERE status = ? AND next_attempt_at <= ? "
+            f"AND recipient IN ({placeholders}) ORDER BY id",
+            (STATUS_PENDING, now, *recipients)
+        ).fetchall()
+        self.conn.executemany(
+            "UPDATE notification_outbox SET status = ? WHERE id = ?",
+            [(STATUS_SENDING, row["id"]) for row in rows]
+        )
+
+        groups = {recipient: [] for recipient in recipients}
+        for row in rows:
+            groups[row["recipient"]].append(self._to_message(row))
+        return list(groups.values())
+
+    def next_due_in(self):
+        """Secondes avant le prochain message dû (None si la file est vide)"""
+        row = self.conn.execute(
+            "SELECT MIN(next_attempt_at) AS due FROM notification_outbox WHERE status = ?", (STATUS_PENDING,)
+        ).fetchone()
+        if row["due"] is None:
+            return None
+        return max(0.0, row["due"] - time.time())
+
+    def complete(self, message_ids):
+        self.conn.executemany("DELETE FROM notification_outbox WHERE id = ?", [(i,) for i in message_ids])
+
+    def retry(self, message_ids, attempts, delay, error):
+        next_attempt_at = time.time() + delay
+        self.conn.executemany(
+            "UPDATE notification_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(STATUS_PENDING, attempts, next_attempt_at, error, i) for i in message_ids]
+        )
+
+    def fail(self, message_ids, error):
+        """Abandon définitif: gardé en base pour diagnostic"""
+        self.conn.executemany(
+            "UPDATE notification_outbox SET status = ?, last_error = ? WHERE id = ?",
+            [(STATUS_FAILED, error, i) for i in message_ids]
+        )
+
+    async def run(self, bot, renderers, digest, workers=OUTBOX_WORKERS, limiter=default_limiter):
+        """
+        Vide la file en continu. `renderers[kind](message)` rend un message seul,
+        `digest(messages)` le récapitulatif de plusieurs messages d'un même destinataire.
+        Les deux retournent une Notification, ou None si plus rien n'est à envoyer;
+        ils lèvent Undeliverable si le destinataire est introuvable.
+        """
+        self._wakeup = asyncio.Event()
+        queue = asyncio.Queue(maxsize=workers * 2)
+
+        async def worker():
+            while True:
+                group = await queue.get()
+                try:
+                    await self._deliver(bot, renderers, digest, group, limiter)
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            while True:
+                self._wakeup.clear()
+                groups = self.claim(workers * 2)
+                for group in groups:
+                    await queue.put(group)
+                if groups:
+                    continue
+
+                timeout = self.next_due_in()
+                timeout = OUTBOX_POLL_INTERVAL if timeout is None else min(timeout, OUTBOX_POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._wakeup = None
+
+    async def _deliver(self, bot, renderers, digest, group, limiter):
+        ids = [message.id for message in group]
+        attempts = max(message.attempts for message in group)
+        label = f"Outbox {ids} ({', '.join(sorted({m.kind for m in group}))})"
+
+        if len(group) == 1:
+            renderer = renderers.get(group[0].kind)
+            if renderer is None:
+                logger.error(f"{label}: no renderer")
+                self.fail(ids, f"Unknown kind: {group[0].kind}")
+                return
+            render = renderer(group[0])
+        else:
+            render = digest(group)
+
+        try:
+            notification = await render
+            if notification is None:
+                self.complete(ids)
+                return
+
+            await limiter.acquire(notification.chat_id)
+            await bot.send_message(chat_id=notification.chat_id, **notification.kwargs)
+            self.complete(ids)
+            logger.info(f"{label} sent to {group[0].recipient}")
+        except Undeliverable as e:
+            logger.warning(f"{label} dropped: {e}")
+            self.fail(ids, str(e))
+        except RetryAfter as e:
+            # Flood control: ne compte pas comme une tentative
+            limiter.pause(e.retry_after)
+            self.retry(ids, attempts, e.retry_after, str(e))
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"{label} dropped: {e}")
+            self.fail(ids, str(e))
+        except Exception as e:
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"{label} failed after {attempts} attempts: {e}")
+                self.fail(ids, str(e))
+                return
+            delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** (attempts - 1))
+            logger.warning(f"{label} attempt {attempts} failed, retrying in {delay}s: {e}")
+            self.retry(ids, attempts, delay, str(e))
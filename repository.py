@@ -0,0 +1,318 @@
+"""
+ACCÈS AUX DONNÉES FIRESTORE (ASYNC)
+Couche d'accès commune à bot.py et api.py, basée sur AsyncClient:
+aucune I/O Firestore ne bloque la boucle d'événements
+"""
+
+import logging
+import os
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from cachetools import LRUCache, TTLCache
+from firebase_admin import firestore, firestore_async
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+from user_cache import UserCache
+
+logger = logging.getLogger(__name__)
+
+USERS_COLLECTION = 'users'
+LEADERBOARD_COLLECTION = 'mainleaderboard'
+# Index user_ids/{user_id} -> {username}, les documents users étant indexés par username
+USER_IDS_COLLECTION = 'user_ids'
+USER_ID_CACHE_SIZE = int(os.getenv("USER_ID_CACHE_SIZE", "100000"))
+
+# username -> (chat_id, user_id) déjà enregistrés par /start, pour sauter les écritures inutiles
+REGISTRATION_CACHE_SIZE = int(os.getenv("REGISTRATION_CACHE_SIZE", "50000"))
+REGISTRATION_CACHE_TTL = float(os.getenv("REGISTRATION_CACHE_TTL", "3600"))
+
+# Date de dernière modification, posée par chaque écriture (exports incrémentaux)
+UPDATED_AT_FIELD = 'updated_at'
+WRITE_BATCH_SIZE = 500
+
+
+def touched(data: Dict) -> Dict:
+    """Ajoute updated_at (horodatage serveur) aux champs écrits"""
+    return {**data, UPDATED_AT_FIELD: firestore.SERVER_TIMESTAMP}
+
+
+def parse_session_time(value) -> Optional[datetime]:
+    """last_session_time (ms, s, chaîne numérique ou Timestamp) -> datetime UTC, ou None"""
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+    if isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            # Au-delà de 10^10 c'est en millisecondes
+            seconds = value / 1000 if value > 10000000000 else value
+            return datetime.fromtimestamp(seconds, tz=timezone.utc)
+        if hasattr(value, 'timestamp'):
+            return datetime.fromtimestamp(value.timestamp(), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        # Valeur hors de la plage des dates (ex: 1e17, NaN)
+        return None
+    return None
+
+
+def leaderboard_entries(docs) -> List[Dict]:
+    """[(doc_id, data), ...] du classement matérialisé -> entrées triées par rang"""
+    entries = []
+    for doc_id, data in sorted(docs, key=lambda d: int(d[0])):
+        entry = dict(data)
+        entry['rank'] = int(doc_id)
+        entries.append(entry)
+    return entries
+
+
+class UserRepository:
+    """Lecture/écriture des documents `users` (clé = username standardisé)"""
+
+    def __init__(self, client, cache: Optional[UserCache] = None):
+        self.client = client
+        self.cache = cache or UserCache()
+        self.registered = TTLCache(maxsize=REGISTRATION_CACHE_SIZE, ttl=REGISTRATION_CACHE_TTL)
+        # user_id -> username (index user_ids en mémoire)
+        self.usernames_by_id = LRUCache(maxsize=USER_ID_CACHE_SIZE)
+
+    @classmethod
+    def from_app(cls, app=None) -> "UserRepository":
+        return cls(firestore_async.client(app=app))
+
+    @property
+    def users(self):
+        return self.client.collection(USERS_COLLECTION)
+
+    def user_ref(self, username: str):
+        return self.users.document(username)
+
+    async def get_user(self, username: str, cached: bool = True) -> Optional[Dict]:
+        """Retourne les données du user, ou None s'il n'existe pas (lecture via le cache)"""
+        if cached:
+            found, data = self.cache.get(username)
+            if found:
+                return data
+
+        doc = await self.user_ref(username).get()
+        data = doc.to_dict() if doc.exists else None
+        self.cache.set(username, data)
+        return data
+
+    async def get_users(self, usernames: List[str]) -> Dict[str, Optional[Dict]]:
+        """Lecture groupée: {username: données ou None}, un seul get_all pour les absents du cache"""
+        result = {}
+        missing = []
+        for username in dict.fromkeys(usernames):
+            found, data = self.cache.get(username)
+            if found:
+                result[username] = data
+            else:
+                missing.append(username)
+
+        if missing:
+            async for doc in self.client.get_all([self.user_ref(username) for username in missing]):
+                data = doc.to_dict() if doc.exists else None
+                self.cache.set(doc.id, data)
+                result[doc.id] = data
+        return result
+
+    async def update_user(self, username: str, data: Dict) -> None:
+        """Met à jour un user existant (échoue s'il n'existe pas)"""
+        try:
+            await self.user_ref(username).update(touched(data))
+        finally:
+            self.invalidate(username)
+
+    async def set_user(self, username: str, data: Dict, merge: bool = False) -> None:
+        try:
+            await self.user_ref(username).set(touched(data), merge=merge)
+        finally:
+            self.invalidate(username)
+
+    async def register_user(self, username: str, chat_id: int, user_id: int, extra: Optional[Dict] = None) -> bool:
+        """
+        Enregistre chat_id/user_id en une seule écriture (created_at posé uniquement à la création).
+        Retourne False si rien n'a changé depuis le dernier enregistrement connu (aucune écriture).
+        """
+        pair = (chat_id, user_id)
+        if not extra and self.registered.get(username) == pair:
+            return False
+
+        found, cached = self.cache.get(username)
+        if not extra and cached is not None and (cached.get("chat_id"), cached.get("user_id")) == pair:
+            self.registered[username] = pair
+            return False
+
+        data = touched({"chat_id": chat_id, "user_id": user_id, **(extra or {})})
+        ref = self.user_ref(username)
+
+        async def write(create):
+            # Le document user et l'index user_id partent dans le même commit
+            batch = self.client.batch()
+            if create:
+                batch.create(ref, {**data, "created_at": firestore.SERVER_TIMESTAMP})
+            else:
+                batch.update(ref, data)
+            batch.set(self.user_id_ref(user_id), {"username": username})
+            await batch.commit()
+
+        try:
+            if found and cached is None:
+                # Inconnu d'après le cache: on tente d'abord la création
+                try:
+                    await write(create=True)
+                except AlreadyExists:
+                    await write(create=False)
+            else:
+                # Cas courant (user qui revient): update avec précondition d'existence
+                try:
+                    await write(create=False)
+                except NotFound:
+                    await write(create=True)
+        finally:
+            self.invalidate(username)
+
+        self.registered[username] = pair
+        self.usernames_by_id[int(user_id)] = username
+        return True
+
+    async def increment_users(self, increments: Dict[str, int], field: str = 'token_balance') -> None:
+        """
+        Applique {username: montant} dans un seul WriteBatch (atomique: tout ou rien).
+        Limité à WRITE_BATCH_SIZE users par appel.
+        """
+        if len(increments) > WRITE_BATCH_SIZE:
+            raise ValueError(f"At most {WRITE_BATCH_SIZE} users per batch")
+
+        batch = self.client.batch()
+        for username, amount in increments.items():
+            batch.update(self.user_ref(username), touched({field: firestore.Increment(amount)}))
+        try:
+            await batch.commit()
+        finally:
+            for username in increments:
+                self.invalidate(username)
+
+    def invalidate(self, username: str) -> None:
+        """Retire un user du cache après une écriture"""
+        self.cache.invalidate(username)
+
+    def user_id_ref(self, user_id: int):
+        return self.client.collection(USER_IDS_COLLECTION).document(str(int(user_id)))
+
+    async def find_user_by_id(self, user_id: int) -> Optional[Tuple[str, Dict]]:
+        """
+        Cherche un user par son ID Telegram: (username, data) ou None.
+        Passe par l'index user_ids (mémoire, sinon lecture directe); la requête
+        where('user_id') ne sert plus que pour les users pas encore indexés.
+        """
+        user_id = int(user_id)
+        username = self.usernames_by_id.get(user_id)
+        if username is None:
+            doc = await self.user_id_ref(user_id).get()
+            if doc.exists:
+                username = doc.to_dict().get('username')
+
+        if username is not None:
+            data = await self.get_user(username)
+            if data is not None and data.get('user_id') == user_id:
+                self.usernames_by_id[user_id] = username
+                return username, data
+            # Index périmé (username changé, user supprimé): on retombe sur la requête
+            self.usernames_by_id.pop(user_id, None)
+
+        query = self.users.where('user_id', '==', user_id).limit(1)
+        async for doc in query.stream():
+            await self.user_id_ref(user_id).set({"username": doc.id})
+            self.usernames_by_id[user_id] = doc.id
+            return doc.id, doc.to_dict()
+        return None
+
+    async def iter_users(self, cursor: Optional[str] = None, page_size: int = 500,
+                         fields: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, Dict]]:
+        """
+        Parcourt les users page par page, triés par ID de document: (username, data).
+        `fields` limite les champs lus (projection Firestore) à ceux dont l'appelant a besoin.
+        """
+        while True:
+            page = await self.get_users_page(cursor, page_size, fields)
+            for username, data in page:
+                yield username, data
+            if len(page) < page_size:
+                return
+            cursor = page[-1][0]
+
+    async def get_users_page(self, cursor: Optional[str], limit: int,
+                             fields: Optional[List[str]] = None) -> List[Tuple[str, Dict]]:
+        """Une page de users triés par ID de document, après `cursor` (seulement `fields` si fourni)"""
+        query = self.users.order_by('__name__').limit(limit)
+        if fields:
+            query = query.select(fields)
+        if cursor:
+            query = query.start_after({'__name__': cursor})
+        return [(doc.id, doc.to_dict()) async for doc in query.stream()]
+
+    async def get_users_where(self, field: str, op: str, value, cursor=None, limit: int = 500,
+                              fields: Optional[List[str]] = None) -> List[Tuple[str, Dict]]:
+        """
+        Une page de users vérifiant `field op value` (filtre côté serveur), triés par (field, ID).
+        `cursor` est le couple (valeur de field, ID) du dernier user de la page précédente.
+        """
+        query = self.users.where(field, op, value)
+        if op == '==':
+            query = query.order_by('__name__')
+            if cursor:
+                query = query.start_after({'__name__': cursor[1]})
+        else:
+            query = query.order_by(field).order_by('__name__')
+            if cursor:
+                query = query.start_after({field: cursor[0], '__name__': cursor[1]})
+        if fields:
+            query = query.select(fields)
+        return [(doc.id, doc.to_dict()) async for doc in query.limit(limit).stream()]
+
+    async def iter_users_where(self, field: str, op: str, value, page_size: int = 500,
+                               fields: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, Dict]]:
+        """Parcourt tous les users vérifiant `field op value`, page par page"""
+        if fields and field not in fields:
+            fields = [*fields, field]  # nécessaire au curseur
+        cursor = None
+        while True:
+            page = await self.get_users_where(field, op, value, cursor, page_size, fields)
+            for username, data in page:
+                yield username, data
+            if len(page) < page_size:
+                return
+            username, data = page[-1]
+            cursor = (data.get(field), username)
+
+    async def count_users(self, *filters: Tuple[str, str, object]) -> int:
+        """Agrégation count() côté serveur, avec filtres optionnels (champ, opérateur, valeur)"""
+        query = self.users
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        result = await query.count(alias='count').get()
+        return int(result[0][0].value)
+
+    async def user_totals(self) -> Dict:
+        """Nombre de users et somme des token_balance, en une seule requête d'agrégation"""
+        query = self.users.count(alias='count').sum('token_balance', alias='total_balance')
+        result = await query.get()
+        values = {aggregation.alias: aggregation.value for aggregation in result[0]}
+        return {"count": int(values['count']), "total_balance": values['total_balance'] or 0}
+
+    async def get_top_holder(self) -> Optional[Tuple[str, Dict]]:
+        """User au plus gros token_balance: (username, data) ou None"""
+        query = self.users.order_by('token_balance', direction=firestore.Query.DESCENDING).limit(1)
+        async for doc in query.select(['token_balance']).stream():
+            return doc.id, doc.to_dict()
+        return None
+
+    async def get_leaderboard(self) -> List[Dict]:
+        """Classement matérialisé, trié par rang (ID de document = rang)"""
+        docs = [(doc.id, doc.to_dict()) async for doc in self.client.collection(LEADERBOARD_COLLECTION).stream()]
+        return leaderboard_entries(docs)
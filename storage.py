@@ -0,0 +1,18 @@
+"""
+STOCKAGE LOCAL
+Base SQLite partagée pour l'état du bot (jobs de broadcast, ...)
+"""
+
+import os
+import sqlite3
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+
+
+def open_state_db(path=STATE_DB_PATH):
+    """Ouvre (et crée si besoin) la base SQLite d'état"""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -0,0 +1,57 @@
+"""
+CACHE DES DOCUMENTS USERS
+Cache LRU borné avec TTL par entrée, invalidé explicitement par nos écritures
+"""
+
+import os
+import time
+
+from cachetools import TLRUCache
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+# Les users inexistants sont gardés moins longtemps (ils peuvent ouvrir l'app entre-temps)
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "5"))
+
+_MISSING = object()
+
+
+class UserCache:
+    """Cache username -> données du user (None = user inexistant)"""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, negative_ttl=USER_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TLRUCache(maxsize=maxsize, ttu=self._ttu, timer=time.monotonic)
+        self.hits = 0
+        self.misses = 0
+
+    def _ttu(self, key, value, now):
+        return now + (self.ttl if value is not None else self.negative_ttl)
+
+    def get(self, username):
+        """Retourne (trouvé, données). Les données sont une copie."""
+        value = self._cache.get(username, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, dict(value) if value is not None else None
+
+    def set(self, username, data):
+        self._cache[username] = dict(data) if data is not None else None
+
+    def invalidate(self, username):
+        self._cache.pop(username, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }